@@ -0,0 +1,271 @@
+import argparse
+import gc
+import json
+import platform
+import random
+import sys
+import tracemalloc
+from math import ceil
+from timeit import default_timer
+from typing import Any, Callable, Dict, List, Sequence, Tuple
+from geometry import Point, Rectangle
+from gen_data import gen_points, gen_point_clusters, gen_point_duplicates, gen_point_skewed, gen_rect_of_area
+from kd_tree import KDTree
+from quadtree import Quadtree
+from morton_quadtree import MortonQuadtree
+from spatial_index import Engine, EngineCost, SpatialIndex
+from tracing import StatsCollector
+
+SCOPE = (0, 100)
+# fractions of the scope's area covered by the queries of a selectivity sweep
+QUERY_AREAS = (0.0001, 0.001, 0.01, 0.1)
+PERCENTILES = (50, 95, 99)
+# metrics where a larger value is better, every other one is a cost
+_HIGHER_IS_BETTER = ('throughput',)
+# metrics compared against a baseline; counts of returned points only have to match exactly
+_COMPARED = ('build_seconds', 'build_peak_bytes', 'retained_bytes', 'throughput', 'nodes_visited') + \
+            tuple('p{}'.format(p) for p in PERCENTILES)
+
+DATASETS: Dict[str, Callable[[int], List[Point]]] = {
+    'uniform': lambda n: gen_points(scope=SCOPE, n=n),
+    'clustered': lambda n: gen_point_clusters(scope=SCOPE, points_per_cluster=n // 5, cluster_amount=5),
+    'skewed': lambda n: gen_point_skewed(scope=SCOPE, n=n),
+    'duplicates': lambda n: gen_point_duplicates(scope=SCOPE, n=n, spot_amount=n // 100 + 1)
+}
+
+# builder and range query of every structure, the query returns the points it found
+STRUCTURES: Dict[str, Tuple[Callable[[List[Point]], Any], Callable[[Any, Rectangle], List[Point]]]] = {
+    'kd_tree': (KDTree, lambda tree, rect: tree.search(*rect.to_tuple())),
+    'quadtree': (Quadtree, lambda tree, rect: tree.find(rect)),
+    'morton_quadtree': (MortonQuadtree, lambda tree, rect: tree.find(rect)),
+    'spatial_index': (SpatialIndex, lambda index, rect: index.search(rect))
+}
+
+
+def percentile(sorted_values: List[float], p: float) -> float:
+    return sorted_values[max(0, ceil(p / 100 * len(sorted_values)) - 1)]
+
+
+# seconds of every build, the garbage collector is off while timing as in timeit
+def measure_build(build: Callable[[List[Point]], Any], points: List[Point], repeats: int) -> List[float]:
+    times = []
+    gc.disable()
+    try:
+        for _ in range(repeats):
+            start_time = default_timer()
+            build(points)
+            times.append(default_timer() - start_time)
+    finally:
+        gc.enable()
+    return times
+
+
+# bytes allocated at the peak of a build and bytes still held by the finished structure
+def measure_memory(build: Callable[[List[Point]], Any], points: List[Point]) -> Tuple[int, int]:
+    gc.collect()
+    tracemalloc.start()
+    starting_mem, _ = tracemalloc.get_traced_memory()
+    tree = build(points)
+    retained, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del tree
+    return peak - starting_mem, retained - starting_mem
+
+
+# the first warmup queries are run untimed, then every query is timed on its own
+def measure_queries(query: Callable[[Any, Rectangle], List[Point]], tree, rectangles: List[Rectangle],
+                    warmup: int) -> Dict[str, float]:
+    for rectangle in rectangles[:warmup]:
+        query(tree, rectangle)
+    times, returned = [], 0
+    gc.disable()
+    try:
+        for rectangle in rectangles:
+            start_time = default_timer()
+            result = query(tree, rectangle)
+            times.append(default_timer() - start_time)
+            returned += len(result)
+    finally:
+        gc.enable()
+    times.sort()
+    result = {'p{}'.format(p): percentile(times, p) for p in PERCENTILES}
+    result['mean'] = sum(times) / len(times)
+    result['throughput'] = len(times) / sum(times) if sum(times) > 0 else float('inf')
+    result['returned'] = returned
+    return result
+
+
+# mean number of node boxes a query tests, counted in a separate untimed pass
+def measure_nodes(query: Callable[[Any, Rectangle], List[Point]], tree, rectangles: List[Rectangle]) -> float:
+    tree.query_stats = StatsCollector()
+    try:
+        for rectangle in rectangles:
+            query(tree, rectangle)
+        return tree.query_stats.total.nodes_visited / len(rectangles)
+    finally:
+        tree.query_stats = None
+
+
+# Every dataset and every query set is generated from its own seed, derived from the run's seed
+# and their names, so a run is reproducible whatever subset of datasets and structures it covers.
+def run(n: int = 10000, queries: int = 200, warmup: int = 20, repeats: int = 3, seed: int = 0,
+        datasets: List[str] = tuple(DATASETS), structures: List[str] = tuple(STRUCTURES),
+        query_areas: List[float] = QUERY_AREAS) -> Dict[str, Any]:
+    report: Dict[str, Any] = {
+        'meta': {
+            'n': n, 'queries': queries, 'warmup': warmup, 'repeats': repeats, 'seed': seed,
+            'python': platform.python_version(), 'implementation': platform.python_implementation(),
+            'machine': platform.machine()
+        },
+        'results': {}
+    }
+    for dataset in datasets:
+        random.seed('{}/{}'.format(seed, dataset))
+        points = DATASETS[dataset](n)
+        rectangles = {}
+        for area in query_areas:
+            random.seed('{}/{}/{}'.format(seed, dataset, area))
+            rectangles[area] = [gen_rect_of_area(SCOPE, area) for _ in range(queries)]
+
+        for structure in structures:
+            build, query = STRUCTURES[structure]
+            sys.stdout.write('\r{} {}        '.format(dataset, structure))
+            sys.stdout.flush()
+            build_times = sorted(measure_build(build, points, repeats))
+            peak, retained = measure_memory(build, points)
+            tree = build(points)
+            queries_results = {}
+            for area in query_areas:
+                queries_results[str(area)] = measure_queries(query, tree, rectangles[area], warmup)
+                if hasattr(tree, 'query_stats'):
+                    queries_results[str(area)]['nodes_visited'] = measure_nodes(query, tree, rectangles[area])
+            report['results'].setdefault(dataset, {})[structure] = {
+                'build': {
+                    'build_seconds': build_times[0],
+                    'build_median_seconds': build_times[len(build_times) // 2],
+                    'build_peak_bytes': peak,
+                    'retained_bytes': retained
+                },
+                'queries': queries_results
+            }
+    sys.stdout.write('\n')
+    return report
+
+
+def _fit_line(xs: Sequence[float], ys: Sequence[float]) -> Tuple[float, float]:
+    mean_x, mean_y = sum(xs) / len(xs), sum(ys) / len(ys)
+    variance = sum((x - mean_x) ** 2 for x in xs)
+    slope = sum((x - mean_x) * (y - mean_y) for x, y in zip(xs, ys)) / variance if variance > 0 else 0.0
+    slope = max(0.0, slope)
+    return slope, max(0.0, mean_y - slope * mean_x)
+
+
+# Times every engine of the index on a sweep of query areas over the index's extent and sets its
+# cost model to a least squares line of seconds against points found per engine. The fit holds
+# for the index's own number of points, so the per-point cost is folded into the fixed one.
+def calibrate_planner(index: SpatialIndex, query_areas: Sequence[float] = QUERY_AREAS, queries: int = 20,
+                      warmup: int = 5, seed: int = 0) -> Dict[Engine, EngineCost]:
+    random.seed('{}/calibration'.format(seed))
+    min_x, min_y = min(index.xs), min(index.ys)
+    width, height = (max(index.xs) - min_x) or 1.0, (max(index.ys) - min_y) or 1.0
+    rectangles = []
+    for area in query_areas:
+        for _ in range(queries):
+            unit = gen_rect_of_area((0, 1), area)
+            rectangles.append(Rectangle(min_x + unit.min_x * width, min_x + unit.max_x * width,
+                                        min_y + unit.min_y * height, min_y + unit.max_y * height))
+    costs: Dict[Engine, EngineCost] = {}
+    for engine in Engine:
+        for rectangle in rectangles[:warmup]:
+            index.search(rectangle, engine=engine)
+        hits, times = [], []
+        gc.disable()
+        try:
+            for rectangle in rectangles:
+                start_time = default_timer()
+                result = index.search(rectangle, engine=engine)
+                times.append(default_timer() - start_time)
+                hits.append(len(result))
+        finally:
+            gc.enable()
+        per_hit, fixed = _fit_line(hits, times)
+        costs[engine] = EngineCost(fixed, per_hit, 0.0)
+    index.costs = costs
+    return costs
+
+
+def flatten(results: Dict[str, Any], prefix: str = '') -> Dict[str, float]:
+    flat: Dict[str, float] = {}
+    for key, value in results.items():
+        if isinstance(value, dict):
+            flat.update(flatten(value, prefix + key + '/'))
+        else:
+            flat[prefix + key] = value
+    return flat
+
+
+# Relative change of every metric present in both reports, positive when the current run is worse.
+# Returns the changes and the names of metrics that got worse by more than the tolerance, along
+# with every count of returned points that differs, as those mean a structure answers differently.
+def compare(current: Dict[str, Any], baseline: Dict[str, Any], tolerance: float) \
+        -> Tuple[Dict[str, float], List[str]]:
+    now, before = flatten(current['results']), flatten(baseline['results'])
+    changes: Dict[str, float] = {}
+    regressions: List[str] = []
+    for key in sorted(now.keys() & before.keys()):
+        metric = key.rsplit('/', 1)[1]
+        if metric == 'returned':
+            if now[key] != before[key]:
+                regressions.append(key)
+            continue
+        if metric not in _COMPARED or before[key] == 0:
+            continue
+        change = (now[key] - before[key]) / before[key]
+        if metric in _HIGHER_IS_BETTER:
+            change = -change
+        changes[key] = change
+        if change > tolerance:
+            regressions.append(key)
+    if current['meta']['n'] != baseline['meta']['n'] or current['meta']['seed'] != baseline['meta']['seed']:
+        sys.stderr.write('warning: the baseline was run with different n or seed\n')
+    return changes, regressions
+
+
+def main(argv: List[str]) -> int:
+    parser = argparse.ArgumentParser(description='Benchmark the search structures on seeded datasets.')
+    parser.add_argument('--n', type=int, default=10000, help='points per dataset')
+    parser.add_argument('--queries', type=int, default=200, help='queries per query area')
+    parser.add_argument('--warmup', type=int, default=20, help='untimed queries before each timed set')
+    parser.add_argument('--repeats', type=int, default=3, help='timed builds per structure, the fastest counts')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--datasets', nargs='+', choices=tuple(DATASETS), default=tuple(DATASETS))
+    parser.add_argument('--structures', nargs='+', choices=tuple(STRUCTURES), default=tuple(STRUCTURES))
+    parser.add_argument('--areas', nargs='+', type=float, default=QUERY_AREAS, help='query areas as scope fractions')
+    parser.add_argument('--output', default='benchmark.json', help='where to write the report')
+    parser.add_argument('--baseline', help='a stored report to compare against')
+    parser.add_argument('--tolerance', type=float, default=0.2, help='relative slowdown counted as a regression')
+    args = parser.parse_args(argv)
+
+    report = run(args.n, args.queries, args.warmup, args.repeats, args.seed, args.datasets, args.structures,
+                 args.areas)
+    with open(args.output, 'w') as file:
+        json.dump(report, file, indent=2, sort_keys=True)
+    for key, value in flatten(report['results']).items():
+        print('{:<60} {:.6g}'.format(key, value))
+    if args.baseline is None:
+        return 0
+
+    with open(args.baseline) as file:
+        baseline = json.load(file)
+    changes, regressions = compare(report, baseline, args.tolerance)
+    print()
+    for key, change in changes.items():
+        print('{:<60} {:+.1%}{}'.format(key, change, '  REGRESSION' if key in regressions else ''))
+    for key in regressions:
+        if key not in changes:
+            print('{:<60} differs from the baseline'.format(key))
+    return 1 if len(regressions) > 0 else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
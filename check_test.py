@@ -0,0 +1,176 @@
+import os
+import random
+import sys
+import tempfile
+from timeit import default_timer
+from typing import Callable, Dict, List
+from geometry import Point, Rectangle
+from flat_tree import SearchMode
+from gen_data import gen_points, gen_point_clusters, gen_point_duplicates, gen_point_skewed, gen_rect
+from kd_tree import KDTree, SplitPolicy
+from quadtree import Quadtree
+from morton_quadtree import MortonQuadtree
+from spatial_index import Engine, SpatialIndex
+
+# Every structure is compared against a brute-force filter of the same points: searches on fresh
+# builds, searches after random inserts and removes, and the parallel builds against serial ones.
+SCOPE = (0, 100)
+# queries and inserted points reach past the points' scope, to cover the growth of the trees' bounds
+_WIDE_SCOPE = (-20, 120)
+
+DATASETS: Dict[str, Callable[[int], List[Point]]] = {
+    'uniform': lambda n: gen_points(scope=SCOPE, n=n),
+    'clustered': lambda n: gen_point_clusters(scope=SCOPE, points_per_cluster=n // 5, cluster_amount=5),
+    'duplicates': lambda n: gen_point_duplicates(scope=SCOPE, n=n, spot_amount=n // 50 + 1),
+    # integer coordinates put many points right on dividing lines, quadrant midlines and Morton cell edges
+    'grid': lambda n: [(float(random.randint(0, 10)), float(random.randint(0, 10))) for _ in range(n)]
+}
+
+
+def brute_force(points: List[Point], rect: Rectangle) -> List[Point]:
+    return sorted(point for point in points if rect.point_inside(point))
+
+
+def gen_query(scope=_WIDE_SCOPE) -> Rectangle:
+    if random.random() < 0.5:
+        return gen_rect(scope)
+    low, high = scope
+    min_x, max_x = sorted(float(random.randint(low, high)) for _ in range(2))
+    min_y, max_y = sorted(float(random.randint(low, high)) for _ in range(2))
+    return Rectangle(min_x, max_x + 1, min_y, max_y + 1)
+
+
+def _searches(structure) -> Dict[str, Callable[[Rectangle, SearchMode], object]]:
+    if isinstance(structure, KDTree):
+        return {'kd_tree': lambda rect, mode: structure.search(*rect.to_tuple(), mode=mode)}
+    if isinstance(structure, SpatialIndex):
+        return {
+            engine.name: lambda rect, mode, engine=engine: structure.search(rect, mode=mode, engine=engine)
+            for engine in Engine
+        }
+    return {type(structure).__name__: lambda rect, mode: structure.find(rect, mode=mode)}
+
+
+def check_searches(structure, points: List[Point], rectangles: List[Rectangle]):
+    for name, search in _searches(structure).items():
+        for rect in rectangles:
+            expected = brute_force(points, rect)
+            assert sorted(search(rect, SearchMode.LIST)) == expected, '{} on {}'.format(name, rect)
+            assert search(rect, SearchMode.COUNT) == len(expected), '{} count on {}'.format(name, rect)
+            found = search(rect, SearchMode.INDICES)
+            assert sorted(points[i] for i in found) == expected, '{} indices on {}'.format(name, rect)
+
+
+# Inserts and removes random points and checks the searches every check_every steps, then removes
+# every point left. Removing a point removes one copy of it, so the expected points are kept as a
+# list with repeats.
+def check_updates(structure, points: List[Point], steps: int, check_every: int = 50):
+    search = next(iter(_searches(structure).values()))
+    live = list(points)
+    for step in range(steps):
+        if random.random() < 0.5 or len(live) == 0:
+            point = (random.uniform(*_WIDE_SCOPE), random.uniform(*_WIDE_SCOPE)) \
+                if random.random() < 0.2 else random.choice(points)
+            structure.insert(point)
+            live.append(point)
+        else:
+            point = live.pop(random.randrange(len(live)))
+            assert structure.remove(point), 'could not remove {}'.format(point)
+        if step % check_every == 0:
+            assert len(structure) == len(live)
+            for _ in range(10):
+                rect = gen_query()
+                assert sorted(search(rect, SearchMode.LIST)) == brute_force(live, rect), 'step {}'.format(step)
+    assert not structure.remove((1000.0, 1000.0))
+    # an emptied structure has to take points again
+    for point in live:
+        assert structure.remove(point), 'could not remove {}'.format(point)
+    assert len(structure) == 0
+    structure.insert((1.0, 2.0))
+    assert search(Rectangle(0, 5, 0, 5), SearchMode.LIST) == [(1.0, 2.0)]
+
+
+def _update_seconds(build: Callable[[List[Point]], object], base: List[Point], points: List[Point]) -> float:
+    structure = build(base)
+    start_time = default_timer()
+    for point in points:
+        structure.insert(point)
+    for point in points:
+        structure.remove(point)
+    return (default_timer() - start_time) / len(points)
+
+
+# Updates of a structure mostly made of copies of one point, or built with an uneven split policy,
+# have to cost about as much as updates of the same structure over uniform points. Rebuilding or
+# rescanning a large subtree on every update makes them hundreds of times slower.
+def check_update_cost(n: int, updates: int = 50, factor: float = 10):
+    uniform, inserted = gen_points(scope=SCOPE, n=n), gen_points(scope=SCOPE, n=updates)
+    copies = [(50.0, 50.0)] * (n * 4 // 5) + gen_points(scope=SCOPE, n=n - n * 4 // 5)
+    skewed = gen_point_skewed(scope=SCOPE, n=n)
+    clustered = gen_point_clusters(scope=SCOPE, points_per_cluster=n // 5, cluster_amount=5)
+    cases = [
+        ('kd_tree', KDTree, copies, [(50.0, 50.0)] * updates),
+        ('kd_tree_leaf_8', lambda points: KDTree(points, leaf_size=8), copies, [(50.0, 50.0)] * updates),
+        ('quadtree', Quadtree, copies, [(50.0, 50.0)] * updates),
+        ('quadtree_leaf_8', lambda points: Quadtree(points, leaf_size=8), copies, [(50.0, 50.0)] * updates),
+        ('kd_tree_sliding_midpoint', lambda points: KDTree(points, split_policy=SplitPolicy.SLIDING_MIDPOINT),
+         skewed, inserted),
+        ('kd_tree_sliding_midpoint', lambda points: KDTree(points, split_policy=SplitPolicy.SLIDING_MIDPOINT),
+         clustered, inserted),
+        ('kd_tree_surface_area', lambda points: KDTree(points, split_policy=SplitPolicy.SURFACE_AREA),
+         clustered, inserted)
+    ]
+    for name, build, base, points in cases:
+        reference = _update_seconds(build, uniform, inserted)
+        seconds = _update_seconds(build, base, points)
+        assert seconds < factor * reference, \
+            '{} updates take {:.3g}s, {:.3g}s on uniform points'.format(name, seconds, reference)
+
+
+# A parallel build has to produce the same arrays as a serial one, so their saved files have to match.
+def check_parallel_build(build: Callable[..., object], points: List[Point], workers: int = 2):
+    directory = tempfile.mkdtemp()
+    files: List[bytes] = []
+    for build_workers in (1, workers):
+        path = os.path.join(directory, str(build_workers))
+        build(points, workers=build_workers).save(path)
+        with open(path, 'rb') as file:
+            files.append(file.read())
+        os.remove(path)
+    os.rmdir(directory)
+    assert files[0] == files[1], 'the parallel build differs from the serial one'
+
+
+def run(n: int = 2000, queries: int = 50, steps: int = 600, seed: int = 0):
+    builders: Dict[str, Callable[[List[Point]], object]] = {
+        'kd_tree': KDTree,
+        'kd_tree_leaf_8': lambda points: KDTree(points, leaf_size=8),
+        'kd_tree_presorted': lambda points: KDTree(points, split_policy=SplitPolicy.EXACT_MEDIAN, presorted=True),
+        'kd_tree_sliding_midpoint': lambda points: KDTree(points, split_policy=SplitPolicy.SLIDING_MIDPOINT),
+        'quadtree': Quadtree,
+        'quadtree_leaf_8': lambda points: Quadtree(points, leaf_size=8),
+        'morton_quadtree': MortonQuadtree
+    }
+    for dataset, generate in DATASETS.items():
+        random.seed('{}/{}'.format(seed, dataset))
+        points = generate(n)
+        rectangles = [gen_query() for _ in range(queries)]
+        for name, build in builders.items():
+            print(dataset, name)
+            check_searches(build(points), points, rectangles)
+            check_updates(build(points), points, steps)
+        print(dataset, 'spatial_index')
+        check_searches(SpatialIndex(points), points, rectangles)
+        print(dataset, 'parallel builds')
+        check_parallel_build(KDTree, points)
+        check_parallel_build(lambda p, workers: KDTree(p, workers=workers, leaf_size=4, presorted=True,
+                                                       split_policy=SplitPolicy.EXACT_MEDIAN), points)
+        check_parallel_build(Quadtree, points)
+    print('update cost')
+    random.seed('{}/update cost'.format(seed))
+    check_update_cost(n)
+
+
+if __name__ == "__main__":
+    run(*map(int, sys.argv[1:]))
+    print('ok')
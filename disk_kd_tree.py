@@ -0,0 +1,199 @@
+import os
+import shutil
+import tempfile
+from array import array
+from collections import OrderedDict
+from typing import List, Optional, Tuple
+from geometry import Point, Rectangle, AxisType
+from kd_tree import KDArrays, MEDIAN_SAMPLE_SIZE, build_subtree, sampled_median
+from point_files import iter_coordinate_chunks, read_coordinates, write_pairs
+
+_FILE_KIND = 'disk_kd_tree'
+_PAIR_SIZE = 16
+Extent = Tuple[float, float, float, float]
+
+
+# Least recently used leaf pages, each an interleaved x, y array read from the page file.
+class PageCache:
+    def __init__(self, file, capacity: int):
+        if capacity < 1:
+            raise ValueError('the page cache has to hold at least one page, got {}'.format(capacity))
+        self.capacity: int = capacity
+        self.hits: int = 0
+        self.misses: int = 0
+        self.__file = file
+        self.__pages: 'OrderedDict[int, array]' = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self.__pages)
+
+    def get(self, node: int, start: int, end: int) -> array:
+        page = self.__pages.get(node)
+        if page is not None:
+            self.hits += 1
+            self.__pages.move_to_end(node)
+            return page
+        self.misses += 1
+        self.__file.seek(start * _PAIR_SIZE)
+        page = array('d')
+        page.frombytes(self.__file.read((end - start) * _PAIR_SIZE))
+        self.__pages[node] = page
+        if len(self.__pages) > self.capacity:
+            self.__pages.popitem(last=False)
+        return page
+
+
+def _extent(xs: array, ys: array, extent: Optional[Extent] = None) -> Extent:
+    if extent is None:
+        return min(xs), max(xs), min(ys), max(ys)
+    return min(extent[0], min(xs)), max(extent[1], max(xs)), min(extent[2], min(ys)), max(extent[3], max(ys))
+
+
+def _sample(run: str, count: int, use_x: bool) -> List[float]:
+    step = max(1, count // MEDIAN_SAMPLE_SIZE)
+    sample, position = [], 0
+    for xs, ys in iter_coordinate_chunks(run, 'raw'):
+        keys = xs if use_x else ys
+        sample.extend(keys[-position % step::step])
+        position += len(keys)
+    return sample
+
+
+# Streams the run into two files, `goes_left(position, key)` picks the side of every point.
+def _partition(run: str, use_x: bool, goes_left, left_run: str, right_run: str) \
+        -> Tuple[int, int, Extent, Extent]:
+    counts, extents = [0, 0], [None, None]
+    position = 0
+    with open(left_run, 'wb') as left_file, open(right_run, 'wb') as right_file:
+        for xs, ys in iter_coordinate_chunks(run, 'raw'):
+            keys = xs if use_x else ys
+            sides = [goes_left(position + i, key) for i, key in enumerate(keys)]
+            position += len(keys)
+            for side, file, keep in ((0, left_file, True), (1, right_file, False)):
+                side_xs = array('d', [x for x, left in zip(xs, sides) if left is keep])
+                side_ys = array('d', [y for y, left in zip(ys, sides) if left is keep])
+                if len(side_xs) > 0:
+                    write_pairs(file, side_xs, side_ys)
+                    counts[side] += len(side_xs)
+                    extents[side] = _extent(side_xs, side_ys, extents[side])
+    return counts[0], counts[1], extents[0], extents[1]
+
+
+# A subtree small enough for memory is built by the regular kd-tree builder, its points are
+# written out in the order of its permutation and its nodes are appended to the directory.
+def _build_in_memory(directory: KDArrays, pages, node: int, run: str):
+    xs, ys = read_coordinates(run, 'raw')
+    os.remove(run)
+    perm = build_subtree(directory, node, xs, ys, directory.start[node])
+    write_pairs(pages, array('d', [xs[i] for i in perm]), array('d', [ys[i] for i in perm]))
+
+
+def _build_external(directory: KDArrays, pages, node: int, run: str, extent: Extent,
+                    memory_points: int, work_dir: str):
+    start, end = directory.start[node], directory.end[node]
+    if end - start <= memory_points:
+        _build_in_memory(directory, pages, node, run)
+        return
+
+    min_x, max_x, min_y, max_y = extent
+    use_x = max_x - min_x >= max_y - min_y
+    low, high = (min_x, max_x) if use_x else (min_y, max_y)
+    left_run, right_run = os.path.join(work_dir, '{}.l'.format(node)), os.path.join(work_dir, '{}.r'.format(node))
+
+    median = sampled_median(_sample(run, end - start, use_x))
+    split = _partition(run, use_x, lambda _, key: key <= median, left_run, right_run)
+    if split[0] == 0 or split[1] == 0:
+        # the sample hit a run of equal coordinates, fall back to the middle of the extent
+        median = (low + high) / 2 if (low + high) / 2 < high else low
+        split = _partition(run, use_x, lambda _, key: key <= median, left_run, right_run)
+    if split[0] == 0 or split[1] == 0:
+        # every point is the same, halve the run by position, the two halves share one box
+        half = start + (end - start) // 2
+        split = _partition(run, use_x, lambda position, _: start + position < half, left_run, right_run)
+    os.remove(run)
+    left_count, _, left_extent, right_extent = split
+
+    directory.dividing_line[node] = median
+    directory.division_axis[node] = (AxisType.Y if use_x else AxisType.X).value
+    middle = start + left_count
+    region = directory.min_x[node], directory.max_x[node], directory.min_y[node], directory.max_y[node]
+    if use_x:
+        first = directory.add_node(start, middle, region[0], median, region[2], region[3])
+        directory.add_node(middle, end, median, region[1], region[2], region[3])
+    else:
+        first = directory.add_node(start, middle, region[0], region[1], region[2], median)
+        directory.add_node(middle, end, region[0], region[1], median, region[3])
+    directory.set_children(node, first, 2)
+    _build_external(directory, pages, first, left_run, left_extent, memory_points, work_dir)
+    _build_external(directory, pages, first + 1, right_run, right_extent, memory_points, work_dir)
+
+
+# A kd-tree whose points live in a page file next to the tree file. Only the node arrays are
+# kept in memory, every leaf is one page of at most page_size points (runs of a single repeated
+# point can make a longer one) stored at perm-like offsets start..end of the page file.
+class DiskKDTree:
+    def __init__(self, path: str, cache_pages: int = 64):
+        self.__tree: KDArrays = KDArrays.load(path, _FILE_KIND, mmap_file=False)[0]
+        self.__pages = open(path + '.pages', 'rb')
+        self.cache: PageCache = PageCache(self.__pages, cache_pages)
+
+    # Builds the tree in bounded memory: the source is copied into a scratch run once, then runs
+    # larger than memory_points are split around a sampled median into two files on disk,
+    # and each run that fits is built in memory and appended to the page file.
+    @staticmethod
+    def build(source: str, path: str, page_size: int = 4096, memory_points: int = 1 << 20,
+              cache_pages: int = 64, work_dir: Optional[str] = None, **options) -> 'DiskKDTree':
+        if memory_points < page_size:
+            raise ValueError('memory_points has to be at least page_size, got {}'.format(memory_points))
+        work_dir = tempfile.mkdtemp(dir=work_dir if work_dir is not None else os.path.dirname(path) or '.')
+        try:
+            run, count, extent = os.path.join(work_dir, 'source'), 0, None
+            with open(run, 'wb') as file:
+                for xs, ys in iter_coordinate_chunks(source, **options):
+                    write_pairs(file, xs, ys)
+                    count += len(xs)
+                    extent = _extent(xs, ys, extent)
+            if count == 0:
+                raise ValueError('cannot build a kd-tree without points')
+
+            directory = KDArrays(array('d'), array('d'), page_size)
+            directory.add_node(0, count, *extent)
+            with open(path + '.pages', 'wb') as pages:
+                _build_external(directory, pages, 0, run, extent, memory_points, work_dir)
+            directory.save(path, _FILE_KIND)
+        finally:
+            shutil.rmtree(work_dir)
+        return DiskKDTree(path, cache_pages)
+
+    def __len__(self) -> int:
+        return len(self.__tree)
+
+    def close(self):
+        self.__pages.close()
+
+    def __enter__(self) -> 'DiskKDTree':
+        return self
+
+    def __exit__(self, *_):
+        self.close()
+
+    def search(self, x_min: float, x_max: float, y_min: float, y_max: float) -> List[Point]:
+        tree, rect = self.__tree, Rectangle(x_min, x_max, y_min, y_max)
+        result: List[Point] = []
+        stack = [0]
+        while len(stack) > 0:
+            node = stack.pop()
+            if not tree.intersects(node, rect):
+                continue
+            if not tree.is_leaf(node):
+                stack.extend(reversed(tree.children(node)))
+                continue
+            page = self.cache.get(node, tree.start[node], tree.end[node])
+            if tree.inside(node, rect):
+                result.extend(zip(page[0::2], page[1::2]))
+            else:
+                result.extend(
+                    (x, y) for x, y in zip(page[0::2], page[1::2])
+                    if rect.min_x < x <= rect.max_x and rect.min_y < y <= rect.max_y
+                )
+        return result
@@ -0,0 +1,914 @@
+import mmap
+import struct
+import sys
+from array import array
+from collections import deque
+from heapq import heappush, heappop, heapreplace
+from math import inf
+from enum import Enum, unique
+from typing import Iterator, List, NamedTuple, Optional, Sequence, Tuple, Union, Any
+
+from geometry import Point, Line, Rectangle
+from tracing import TraceEvent, Tracer
+
+PointSource = Union[Sequence[Point], Any]
+RectangleSource = Union[Sequence[Union[Rectangle, Tuple[float, float, float, float]]], Any]
+QueryBox = Tuple[float, float, float, float]
+
+
+@unique
+class SearchMode(Enum):
+    LIST = 0
+    ITER = 1
+    COUNT = 2
+    EXISTS = 3
+    # an array('q') of the ids of the points found, or of their indices for a tree without ids
+    INDICES = 4
+
+
+# Reductions over the values of the points in a range. COUNT needs no values; SUM of no points
+# is 0, MIN and MAX of no points are None.
+@unique
+class Aggregate(Enum):
+    COUNT = 0
+    SUM = 1
+    MIN = 2
+    MAX = 3
+
+
+def as_coordinates(points: PointSource) -> Tuple[array, array]:
+    try:
+        view = memoryview(points)
+    except TypeError:
+        return array('d', [p[0] for p in points]), array('d', [p[1] for p in points])
+
+    if view.ndim > 2 or (view.ndim == 2 and view.shape[1] != 2):
+        raise ValueError('expected an (n, 2) coordinate buffer, got shape {}'.format(view.shape))
+    if not view.c_contiguous:
+        raise ValueError('coordinate buffer has to be C-contiguous')
+    item_format = view.format.lstrip('@=<')
+    flat = view.cast('B').cast(item_format) if view.ndim != 1 or item_format != view.format else view
+    if len(flat) % 2 != 0:
+        raise ValueError('flat coordinate buffer has to hold interleaved (x, y) pairs')
+    if flat.format == 'd':
+        coords = array('d')
+        coords.frombytes(flat.cast('B'))
+    else:
+        coords = array('d', flat.tolist())
+    return coords[0::2], coords[1::2]
+
+
+def as_values(values: Sequence[float], count: int) -> array:
+    if len(values) != count:
+        raise ValueError('got {} values for {} points'.format(len(values), count))
+    return array('d', values)
+
+
+def as_ids(ids: Sequence[int], count: int) -> array:
+    if len(ids) != count:
+        raise ValueError('got {} ids for {} points'.format(len(ids), count))
+    return array('q', ids)
+
+
+def as_query_boxes(rectangles: RectangleSource) -> List[QueryBox]:
+    try:
+        view = memoryview(rectangles)
+    except TypeError:
+        return [r.to_tuple() if isinstance(r, Rectangle) else tuple(r) for r in rectangles]
+
+    if view.ndim > 2 or (view.ndim == 2 and view.shape[1] != 4):
+        raise ValueError('expected an (n, 4) rectangle buffer, got shape {}'.format(view.shape))
+    if not view.c_contiguous:
+        raise ValueError('rectangle buffer has to be C-contiguous')
+    item_format = view.format.lstrip('@=<')
+    values = (view.cast('B').cast(item_format) if view.ndim != 1 or item_format != view.format else view).tolist()
+    if len(values) % 4 != 0:
+        raise ValueError('flat rectangle buffer has to hold (min_x, max_x, min_y, max_y) rows')
+    return list(zip(values[0::4], values[1::4], values[2::4], values[3::4]))
+
+
+# the share of the extent low..high covered by range_low..range_high
+def _overlap(low: float, high: float, range_low: float, range_high: float) -> float:
+    if high <= low:
+        return 1.0
+    return max(0.0, min(high, range_high) - max(low, range_low)) / (high - low)
+
+
+class TreeStats(NamedTuple):
+    nodes: int
+    leaves: int
+    max_depth: int
+    # depth of the leaf holding an average point, i.e. how many nodes a point lookup visits
+    mean_point_depth: float
+    max_leaf_size: int
+    # the largest share of a node's points that went to one of its children, 1 / (number of
+    # children) for a perfectly balanced tree
+    max_child_share: float
+    # bytes of the point, permutation and node arrays, mapped ones included
+    memory_bytes: int
+
+
+_FILE_MAGIC = b'GEOTREE\0'
+_FILE_VERSION = 5
+# slots for the build settings of the tree's owner, so that a loaded tree keeps updating the same way
+_FILE_SETTINGS = 4
+# magic, format version, byte order, tree kind, leaf size, dead nodes, dead slots, column count, settings
+_FILE_HEADER = struct.Struct('<8sIc16sqqqI{}q'.format(_FILE_SETTINGS))
+# column name, array typecode, offset of the data from the start of the file, item count
+_FILE_COLUMN = struct.Struct('<16scqq')
+
+
+# Every node of the tree is a row in a set of parallel arrays. Points are never moved, the tree
+# reorders the permutation `perm` instead, so that each node owns the contiguous range
+# perm[start:end] and the bounding box min_x..max_y of all of those points.
+# Updates never shift existing rows: a leaf that grows is moved to the end of perm and rebuilt
+# subtrees get fresh nodes, so ancestors of a changed leaf lose their contiguous range
+# (start = end = -1) and the abandoned rows are counted until the owner rebuilds the tree.
+class FlatTree:
+    COLUMNS: Tuple[str, ...] = (
+        'start', 'end', 'child_first', 'child_count', 'min_x', 'max_x', 'min_y', 'max_y', 'size'
+    )
+    # arrays of the whole tree rather than of its nodes, saved along with the columns
+    EXTRA: Tuple[str, ...] = ()
+    # summaries of the values below each node, columns of trees built with values only
+    VALUE_COLUMNS: Tuple[str, ...] = ('value_sum', 'value_min', 'value_max')
+
+    def __init__(self, xs: array, ys: array, leaf_size: int = 1, perm: Optional[array] = None):
+        if leaf_size < 1:
+            raise ValueError('leaf size has to be positive, got {}'.format(leaf_size))
+        self.leaf_size: int = leaf_size
+        self.xs: array = xs
+        self.ys: array = ys
+        self.perm: array = perm if perm is not None else array('q', range(len(xs)))
+
+        self.start: array = array('q')
+        self.end: array = array('q')
+        self.child_first: array = array('q')
+        self.child_count: array = array('b')
+        self.min_x: array = array('d')
+        self.max_x: array = array('d')
+        self.min_y: array = array('d')
+        self.max_y: array = array('d')
+        self.size: array = array('q')
+
+        self.free: array = array('q')
+        self.dead_nodes: int = 0
+        self.dead_slots: int = 0
+        self.read_only: bool = False
+        # caller's ids of the points, parallel to xs and ys; without them a point is known by its index
+        self.ids: Optional[array] = None
+        # caller's weights or values of the points, parallel to xs and ys, see set_values
+        self.values: Optional[array] = None
+        self.value_sum: Optional[array] = None
+        self.value_min: Optional[array] = None
+        self.value_max: Optional[array] = None
+
+    def __len__(self) -> int:
+        return self.size[0] if self.node_count > 0 else 0
+
+    @property
+    def node_count(self) -> int:
+        return len(self.start)
+
+    def add_node(self, start: int, end: int, min_x: float, max_x: float, min_y: float, max_y: float) -> int:
+        self.start.append(start)
+        self.end.append(end)
+        self.child_first.append(-1)
+        self.child_count.append(0)
+        self.min_x.append(min_x)
+        self.max_x.append(max_x)
+        self.min_y.append(min_y)
+        self.max_y.append(max_y)
+        self.size.append(end - start)
+        if self.values is not None:
+            self.value_sum.append(0.0)
+            self.value_min.append(inf)
+            self.value_max.append(-inf)
+        return len(self.start) - 1
+
+    def column_names(self) -> Tuple[str, ...]:
+        return self.COLUMNS + self.VALUE_COLUMNS if self.values is not None else self.COLUMNS
+
+    def columns(self) -> List[array]:
+        return [getattr(self, name) for name in self.column_names()]
+
+    # Gives every point a value and every node the sum, minimum and maximum of the values below it.
+    def set_values(self, values: array):
+        self.__check_writable()
+        self.values = values
+        self.value_sum = array('d', [0.0]) * self.node_count
+        self.value_min = array('d', [inf]) * self.node_count
+        self.value_max = array('d', [-inf]) * self.node_count
+        self.tighten(0)
+
+    # columns filled in by a builder when it splits a node
+    def split_columns(self) -> List[array]:
+        return [self.child_first, self.child_count]
+
+    # Places a subtree built on its own, given as columns numbered from its root, below `node`:
+    # the root fills in the split columns of the node, the other rows are appended with their
+    # children renumbered and their point ranges moved by point_offset.
+    def append_subtree(self, node: int, columns: List[array], point_offset: int = 0):
+        base = self.node_count - 1
+        split_columns = self.split_columns()
+        for column, subtree_column in zip(self.columns(), columns):
+            if any(column is split_column for split_column in split_columns):
+                column[node] = subtree_column[0]
+            column.extend(subtree_column[1:])
+        if self.child_first[node] >= 0:
+            self.child_first[node] += base
+        for row in range(base + 1, self.node_count):
+            if self.child_first[row] >= 0:
+                self.child_first[row] += base
+            self.start[row] += point_offset
+            self.end[row] += point_offset
+
+    def copy_node(self, node: int) -> int:
+        for column in self.columns():
+            column.append(column[node])
+        return len(self.start) - 1
+
+    def clear_nodes(self):
+        for column in self.columns():
+            del column[:]
+        self.dead_nodes = 0
+        self.dead_slots = 0
+
+    def reset(self, indices: array):
+        self.clear_nodes()
+        self.perm = indices
+        if len(indices) == 0:
+            self.add_node(0, 0, 0.0, 0.0, 0.0, 0.0)
+            return
+        x_coords = [self.xs[i] for i in indices]
+        y_coords = [self.ys[i] for i in indices]
+        self.add_node(0, len(indices), min(x_coords), max(x_coords), min(y_coords), max(y_coords))
+
+    def needs_compaction(self) -> bool:
+        live_nodes = self.node_count - self.dead_nodes
+        return self.dead_nodes > max(live_nodes, 64) or self.dead_slots > max(len(self), 64)
+
+    def stats(self) -> TreeStats:
+        nodes = leaves = max_depth = depth_sum = max_leaf_size = 0
+        max_child_share = 0.0
+        stack = [(0, 0)] if self.node_count > 0 else []
+        while len(stack) > 0:
+            node, depth = stack.pop()
+            nodes += 1
+            if self.is_leaf(node):
+                leaves += 1
+                max_depth = max(max_depth, depth)
+                depth_sum += depth * self.size[node]
+                max_leaf_size = max(max_leaf_size, self.size[node])
+                continue
+            if self.size[node] > 0:
+                max_child_share = max(
+                    max_child_share, max(self.size[child] for child in self.children(node)) / self.size[node]
+                )
+            stack.extend((child, depth + 1) for child in self.children(node))
+        arrays = self.columns() + [self.xs, self.ys, self.perm, self.free]
+        if self.ids is not None:
+            arrays.append(self.ids)
+        if self.values is not None:
+            arrays.append(self.values)
+        return TreeStats(
+            nodes, leaves, max_depth, depth_sum / len(self) if len(self) > 0 else 0.0, max_leaf_size, max_child_share,
+            sum(len(column) * column.itemsize for column in arrays)
+        )
+
+    # Shrinks the boxes of the subtree to the extent of the points below each node, children
+    # first. Builders split nodes by regions, this is what makes the boxes tight afterwards.
+    # The value summaries of a tree with values are refreshed in the same pass.
+    def tighten(self, node: int = 0):
+        child_first, child_count = self.child_first, self.child_count
+        order, stack = [], [node]
+        while len(stack) > 0:
+            node = stack.pop()
+            order.append(node)
+            if child_count[node] > 0:
+                stack.extend(range(child_first[node], child_first[node] + child_count[node]))
+        min_xs, max_xs, min_ys, max_ys = self.min_x, self.max_x, self.min_y, self.max_y
+        xs, ys, perm, starts, ends = self.xs, self.ys, self.perm, self.start, self.end
+        values, sums, mins, maxs = self.values, self.value_sum, self.value_min, self.value_max
+        for node in reversed(order):
+            first, count = child_first[node], child_count[node]
+            if count > 0:
+                last = first + count
+                min_xs[node], max_xs[node] = min(min_xs[first:last]), max(max_xs[first:last])
+                min_ys[node], max_ys[node] = min(min_ys[first:last]), max(max_ys[first:last])
+                if values is not None:
+                    sums[node] = sum(sums[first:last])
+                    mins[node], maxs[node] = min(mins[first:last]), max(maxs[first:last])
+            elif ends[node] - starts[node] == 1:
+                i = perm[starts[node]]
+                min_xs[node] = max_xs[node] = xs[i]
+                min_ys[node] = max_ys[node] = ys[i]
+                if values is not None:
+                    sums[node] = mins[node] = maxs[node] = values[i]
+            else:
+                self.__fit(node)
+
+    # A leaf whose tight box is a single point holds copies of that point only. Adding or removing
+    # another copy leaves its box as it is, so it needs no split and no rescan of its points.
+    def holds_copies(self, node: int) -> bool:
+        return self.child_count[node] == 0 and self.size[node] > 0 and \
+            self.min_x[node] == self.max_x[node] and self.min_y[node] == self.max_y[node]
+
+    # refits the boxes along a root to leaf path after the leaf lost the point at `index`
+    def tighten_path(self, path: List[int], index: int):
+        leaf = path[-1]
+        if self.holds_copies(leaf):
+            # only the value summary can change, and its minimum and maximum only if they were the removed value
+            if self.values is not None:
+                value = self.values[index]
+                self.value_sum[leaf] -= value
+                if value <= self.value_min[leaf] or value >= self.value_max[leaf]:
+                    self.__fit(leaf)
+            path = path[:-1]
+        for node in reversed(path):
+            self.__fit(node)
+
+    # An empty node gets an inverted box, which no query intersects and any point expands.
+    def __fit(self, node: int):
+        if not self.is_leaf(node):
+            first, last = self.child_first[node], self.child_first[node] + self.child_count[node]
+            self.min_x[node], self.max_x[node] = min(self.min_x[first:last]), max(self.max_x[first:last])
+            self.min_y[node], self.max_y[node] = min(self.min_y[first:last]), max(self.max_y[first:last])
+            if self.values is not None:
+                self.value_sum[node] = sum(self.value_sum[first:last])
+                self.value_min[node] = min(self.value_min[first:last])
+                self.value_max[node] = max(self.value_max[first:last])
+            return
+        segment = self.perm[self.start[node]:self.end[node]]
+        if len(segment) == 0:
+            self.min_x[node], self.max_x[node], self.min_y[node], self.max_y[node] = inf, -inf, inf, -inf
+        else:
+            x_coords = [self.xs[i] for i in segment]
+            y_coords = [self.ys[i] for i in segment]
+            self.min_x[node], self.max_x[node] = min(x_coords), max(x_coords)
+            self.min_y[node], self.max_y[node] = min(y_coords), max(y_coords)
+        if self.values is not None:
+            values = [self.values[i] for i in segment]
+            self.value_sum[node] = sum(values)
+            self.value_min[node], self.value_max[node] = min(values, default=inf), max(values, default=-inf)
+
+    def subtree_node_count(self, node: int) -> int:
+        count, stack = 0, [node]
+        while len(stack) > 0:
+            count += 1
+            stack.extend(self.children(stack.pop()))
+        return count
+
+    def add_point(self, x: float, y: float, point_id: Optional[int] = None, value: Optional[float] = None) -> int:
+        self.__check_writable()
+        if (point_id is None) != (self.ids is None):
+            raise ValueError('a point needs an id exactly when the tree was built with ids')
+        if (value is None) != (self.values is None):
+            raise ValueError('a point needs a value exactly when the tree was built with values')
+        if len(self.free) > 0:
+            index = self.free.pop()
+            self.xs[index] = x
+            self.ys[index] = y
+            if self.ids is not None:
+                self.ids[index] = point_id
+            if self.values is not None:
+                self.values[index] = value
+            return index
+        self.xs.append(x)
+        self.ys.append(y)
+        if self.ids is not None:
+            self.ids.append(point_id)
+        if self.values is not None:
+            self.values.append(value)
+        return len(self.xs) - 1
+
+    # grows the node's box and value summary by a point that is being added below it
+    def expand(self, node: int, x: float, y: float, value: Optional[float] = None):
+        self.min_x[node] = min(self.min_x[node], x)
+        self.max_x[node] = max(self.max_x[node], x)
+        self.min_y[node] = min(self.min_y[node], y)
+        self.max_y[node] = max(self.max_y[node], y)
+        if value is not None:
+            self.value_sum[node] += value
+            self.value_min[node] = min(self.value_min[node], value)
+            self.value_max[node] = max(self.value_max[node], value)
+
+    def __check_writable(self):
+        if self.read_only:
+            raise ValueError('the tree is a read-only memory mapping of a saved file')
+
+    def save(self, path: str, kind: str, settings: Sequence[int] = ()):
+        if len(settings) > _FILE_SETTINGS:
+            raise ValueError('a tree file holds at most {} settings, got {}'.format(_FILE_SETTINGS, len(settings)))
+        names = ('xs', 'ys', 'perm', 'free') + (('ids',) if self.ids is not None else ()) + \
+            (('values',) if self.values is not None else ()) + self.EXTRA + self.column_names()
+        columns = [getattr(self, name) for name in names]
+        offset = _FILE_HEADER.size + len(names) * _FILE_COLUMN.size
+        table = []
+        for name, column in zip(names, columns):
+            offset += -offset % 8
+            table.append(_FILE_COLUMN.pack(name.encode(), column.typecode.encode(), offset, len(column)))
+            offset += len(column) * column.itemsize
+
+        with open(path, 'wb') as file:
+            file.write(_FILE_HEADER.pack(
+                _FILE_MAGIC, _FILE_VERSION, sys.byteorder[0].encode(), kind.encode(),
+                self.leaf_size, self.dead_nodes, self.dead_slots, len(names),
+                *settings, *[0] * (_FILE_SETTINGS - len(settings))
+            ))
+            file.write(b''.join(table))
+            for column in columns:
+                file.write(bytes(-file.tell() % 8))
+                file.write(column.tobytes() if isinstance(column, array) else bytes(column))
+
+    # With mmap=True the columns are read-only views of the mapped file, so every process that
+    # loads the same file shares one copy of it in the page cache. Returns the tree and the settings
+    # it was saved with, unused slots are 0.
+    @classmethod
+    def load(cls, path: str, kind: str, mmap_file: bool = True) -> Tuple['FlatTree', Tuple[int, ...]]:
+        with open(path, 'rb') as file:
+            if mmap_file:
+                data = memoryview(mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ))
+            else:
+                data = memoryview(file.read())
+
+        magic, version, byte_order, file_kind, leaf_size, dead_nodes, dead_slots, column_count, *settings = \
+            _FILE_HEADER.unpack_from(data)
+        if magic != _FILE_MAGIC:
+            raise ValueError('{} is not a saved tree'.format(path))
+        if version != _FILE_VERSION:
+            raise ValueError('unsupported tree file version {} in {}'.format(version, path))
+        if byte_order != sys.byteorder[0].encode():
+            raise ValueError('{} was saved on a machine with a different byte order'.format(path))
+        if file_kind.rstrip(b'\0').decode() != kind:
+            raise ValueError('{} holds a {}, not a {}'.format(path, file_kind.rstrip(b'\0').decode(), kind))
+
+        columns = {}
+        for i in range(column_count):
+            name, typecode, offset, length = _FILE_COLUMN.unpack_from(data, _FILE_HEADER.size + i * _FILE_COLUMN.size)
+            typecode = typecode.decode()
+            size = length * array(typecode).itemsize
+            if mmap_file:
+                columns[name.rstrip(b'\0').decode()] = data[offset:offset + size].cast(typecode)
+            else:
+                column = array(typecode)
+                column.frombytes(data[offset:offset + size])
+                columns[name.rstrip(b'\0').decode()] = column
+
+        tree = cls(columns.pop('xs'), columns.pop('ys'), leaf_size, perm=columns.pop('perm'))
+        for name, column in columns.items():
+            setattr(tree, name, column)
+        tree.dead_nodes = dead_nodes
+        tree.dead_slots = dead_slots
+        tree.read_only = mmap_file
+        return tree, tuple(settings)
+
+    def __scatter(self, path: List[int]):
+        for node in path[:-1]:
+            self.start[node] = -1
+            self.end[node] = -1
+
+    # Returns the path from the root to the leaf holding the point and the point's position in perm.
+    def locate(self, x: float, y: float) -> Optional[Tuple[List[int], int]]:
+        path: List[int] = []
+        stack = [(0, 0)] if self.node_count > 0 else []
+        while len(stack) > 0:
+            node, depth = stack.pop()
+            if self.size[node] == 0 or not (
+                    self.min_x[node] <= x <= self.max_x[node] and self.min_y[node] <= y <= self.max_y[node]
+            ):
+                continue
+            del path[depth:]
+            path.append(node)
+            if not self.is_leaf(node):
+                stack.extend((child, depth + 1) for child in reversed(self.children(node)))
+                continue
+            for position in range(self.start[node], self.end[node]):
+                index = self.perm[position]
+                if self.xs[index] == x and self.ys[index] == y:
+                    return path, position
+        return None
+
+    def append_to_leaf(self, path: List[int], index: int):
+        leaf = path[-1]
+        if self.end[leaf] == len(self.perm):
+            self.perm.append(index)
+        else:
+            segment = self.node_indices(leaf)
+            segment.append(index)
+            self.dead_slots += len(segment) - 1
+            self.start[leaf] = len(self.perm)
+            self.perm.extend(segment)
+        self.end[leaf] = len(self.perm)
+        for node in path:
+            self.size[node] += 1
+        self.__scatter(path)
+
+    def remove_at(self, path: List[int], position: int) -> int:
+        self.__check_writable()
+        leaf = path[-1]
+        index = self.perm[position]
+        last = self.end[leaf] - 1
+        self.perm[position] = self.perm[last]
+        self.end[leaf] = last
+        self.dead_slots += 1
+        for node in path:
+            self.size[node] -= 1
+        self.__scatter(path)
+        self.free.append(index)
+        return index
+
+    # Turns a subtree into a single leaf holding all of its points, ready to be split again.
+    def collapse(self, node: int):
+        if self.is_leaf(node):
+            return
+        self.dead_nodes += self.subtree_node_count(node) - 1
+        if self.start[node] < 0:
+            indices = self.node_indices(node)
+            self.dead_slots += len(indices)
+            self.start[node] = len(self.perm)
+            self.perm.extend(indices)
+            self.end[node] = len(self.perm)
+        self.set_children(node, -1, 0)
+
+    def set_children(self, node: int, first: int, count: int):
+        self.child_first[node] = first
+        self.child_count[node] = count
+
+    def is_leaf(self, node: int) -> bool:
+        return self.child_count[node] == 0
+
+    def children(self, node: int) -> range:
+        first = self.child_first[node]
+        return range(first, first + self.child_count[node])
+
+    def point(self, index: int) -> Point:
+        return self.xs[index], self.ys[index]
+
+    def ids_of(self, indices: array) -> array:
+        if self.ids is None:
+            return indices
+        ids = self.ids
+        return array('q', [ids[i] for i in indices])
+
+    def ids_of_many(self, indices: array, offsets: array) -> Tuple[array, array]:
+        return self.ids_of(indices), offsets
+
+    def points(self, indices: Sequence[int]) -> List[Point]:
+        xs, ys = self.xs, self.ys
+        return [(xs[i], ys[i]) for i in indices]
+
+    def all_points(self) -> List[Point]:
+        if self.dead_slots == 0 and len(self.free) == 0:
+            return list(zip(self.xs, self.ys))
+        return self.node_points(0)
+
+    def node_indices(self, node: int) -> array:
+        if self.start[node] >= 0:
+            return self.perm[self.start[node]:self.end[node]]
+        result = array('q')
+        stack = [node]
+        while len(stack) > 0:
+            node = stack.pop()
+            if self.start[node] >= 0:
+                result.extend(self.perm[self.start[node]:self.end[node]])
+            else:
+                stack.extend(reversed(self.children(node)))
+        return result
+
+    def node_points(self, node: int) -> List[Point]:
+        return self.points(self.node_indices(node))
+
+    def node_lines(self, node: int) -> List[Line]:
+        min_x, max_x, min_y, max_y = self.min_x[node], self.max_x[node], self.min_y[node], self.max_y[node]
+        return [
+            ((min_x, min_y), (max_x, min_y)),
+            ((max_x, min_y), (max_x, max_y)),
+            ((max_x, max_y), (min_x, max_y)),
+            ((min_x, max_y), (min_x, min_y))
+        ]
+
+    # Points are matched with Rectangle.point_inside semantics, i.e. min < coordinate <= max,
+    # while a node's box is closed, so the comparisons below differ on each side.
+    def inside(self, node: int, rect: Rectangle) -> bool:
+        return (
+                rect.min_x < self.min_x[node] and self.max_x[node] <= rect.max_x and
+                rect.min_y < self.min_y[node] and self.max_y[node] <= rect.max_y
+        )
+
+    def intersects(self, node: int, rect: Rectangle) -> bool:
+        return (
+                self.max_x[node] > rect.min_x and self.min_x[node] <= rect.max_x and
+                self.max_y[node] > rect.min_y and self.min_y[node] <= rect.max_y
+        )
+
+    def search_range(self, rect: Rectangle, tracer: Optional[Tracer] = None) -> array:
+        result = array('q')
+        if self.node_count == 0:
+            return result
+        if tracer is None:
+            self.__search(rect, result)
+        else:
+            self.__search_traced(rect, result, tracer)
+        return result
+
+    # All of the traversals below keep their pending nodes on an explicit stack, children pushed
+    # in reverse so they are visited in the order a recursive walk would take, and their depth is
+    # bounded by memory only. The plain search inlines the box tests over local column references.
+    def __search(self, rect: Rectangle, result: array):
+        min_xs, max_xs, min_ys, max_ys = self.min_x, self.max_x, self.min_y, self.max_y
+        child_first, child_count = self.child_first, self.child_count
+        r_min_x, r_max_x, r_min_y, r_max_y = rect.min_x, rect.max_x, rect.min_y, rect.max_y
+        stack = [0]
+        while len(stack) > 0:
+            node = stack.pop()
+            min_x, max_x, min_y, max_y = min_xs[node], max_xs[node], min_ys[node], max_ys[node]
+            if max_x <= r_min_x or min_x > r_max_x or max_y <= r_min_y or min_y > r_max_y:
+                continue
+            if r_min_x < min_x and max_x <= r_max_x and r_min_y < min_y and max_y <= r_max_y:
+                result.extend(self.node_indices(node))
+            elif child_count[node] == 0:
+                result.extend(self.leaf_hits(node, rect))
+            else:
+                first = child_first[node]
+                stack.extend(range(first + child_count[node] - 1, first - 1, -1))
+
+    def __search_traced(self, rect: Rectangle, result: array, tracer: Tracer):
+        stack = [0]
+        while len(stack) > 0:
+            node = stack.pop()
+            first_hit = len(result)
+            if not self.intersects(node, rect):
+                tracer(TraceEvent.PRUNE, node, first_hit, first_hit)
+            elif self.inside(node, rect):
+                result.extend(self.node_indices(node))
+                tracer(TraceEvent.TAKE, node, first_hit, len(result))
+            elif self.is_leaf(node):
+                result.extend(self.leaf_hits(node, rect))
+                tracer(TraceEvent.SCAN, node, first_hit, len(result))
+            else:
+                tracer(TraceEvent.VISIT, node, first_hit, first_hit)
+                stack.extend(reversed(self.children(node)))
+
+    def iter_range(self, rect: Rectangle) -> Iterator[int]:
+        stack = [0] if self.node_count > 0 else []
+        while len(stack) > 0:
+            node = stack.pop()
+            if not self.intersects(node, rect):
+                continue
+            if self.inside(node, rect):
+                yield from self.node_indices(node)
+            elif self.is_leaf(node):
+                yield from self.leaf_hits(node, rect)
+            else:
+                stack.extend(reversed(self.children(node)))
+
+    def count_range(self, rect: Rectangle, node: int = 0) -> int:
+        count, stack = 0, [node]
+        while len(stack) > 0:
+            node = stack.pop()
+            if not self.intersects(node, rect):
+                continue
+            if self.inside(node, rect):
+                count += self.size[node]
+            elif self.is_leaf(node):
+                count += len(self.leaf_hits(node, rect))
+            else:
+                stack.extend(self.children(node))
+        return count
+
+    # The number of points in the range, estimated from node sizes alone. Nodes are expanded level
+    # by level until max_nodes boxes were tested; a node cut by the range that is not expanded
+    # counts with the share of its box the range covers, as if its points were spread evenly.
+    def estimate_count(self, rect: Rectangle, max_nodes: int = 64) -> float:
+        estimate, tested = 0.0, 0
+        queue = deque([0] if self.node_count > 0 else [])
+        while len(queue) > 0:
+            node = queue.popleft()
+            tested += 1
+            if not self.intersects(node, rect):
+                continue
+            if self.inside(node, rect):
+                estimate += self.size[node]
+            elif self.is_leaf(node) or tested + len(queue) + self.child_count[node] > max_nodes:
+                estimate += self.size[node] * _overlap(self.min_x[node], self.max_x[node], rect.min_x, rect.max_x) \
+                    * _overlap(self.min_y[node], self.max_y[node], rect.min_y, rect.max_y)
+            else:
+                queue.extend(self.children(node))
+        return estimate
+
+    # Nodes inside of the range contribute their summaries, so only the leaves on its border are
+    # read point by point.
+    def aggregate_range(self, rect: Rectangle, op: Aggregate) -> Optional[float]:
+        if op is Aggregate.COUNT:
+            return self.count_range(rect)
+        if self.values is None:
+            raise ValueError('{} needs a tree built with values'.format(op))
+        summary = {Aggregate.SUM: self.value_sum, Aggregate.MIN: self.value_min, Aggregate.MAX: self.value_max}[op]
+        combine = {Aggregate.SUM: sum, Aggregate.MIN: min, Aggregate.MAX: max}[op]
+        min_xs, max_xs, min_ys, max_ys = self.min_x, self.max_x, self.min_y, self.max_y
+        child_first, child_count, values = self.child_first, self.child_count, self.values
+        r_min_x, r_max_x, r_min_y, r_max_y = rect.min_x, rect.max_x, rect.min_y, rect.max_y
+        parts: List[float] = []
+        stack = [0] if self.node_count > 0 else []
+        while len(stack) > 0:
+            node = stack.pop()
+            min_x, max_x, min_y, max_y = min_xs[node], max_xs[node], min_ys[node], max_ys[node]
+            if max_x <= r_min_x or min_x > r_max_x or max_y <= r_min_y or min_y > r_max_y:
+                continue
+            if r_min_x < min_x and max_x <= r_max_x and r_min_y < min_y and max_y <= r_max_y:
+                parts.append(summary[node])
+            elif child_count[node] == 0:
+                hits = self.leaf_hits(node, rect)
+                if len(hits) > 0:
+                    parts.append(combine(values[i] for i in hits))
+            else:
+                first = child_first[node]
+                stack.extend(range(first, first + child_count[node]))
+        if op is Aggregate.SUM:
+            return sum(parts)
+        return combine(parts) if len(parts) > 0 else None
+
+    def any_in_range(self, rect: Rectangle, node: int = 0) -> bool:
+        xs, ys = self.xs, self.ys
+        stack = [node]
+        while len(stack) > 0:
+            node = stack.pop()
+            if not self.intersects(node, rect) or self.size[node] == 0:
+                continue
+            if self.inside(node, rect):
+                return True
+            if not self.is_leaf(node):
+                stack.extend(reversed(self.children(node)))
+            elif any(
+                    rect.min_x < xs[i] <= rect.max_x and rect.min_y < ys[i] <= rect.max_y
+                    for i in self.node_indices(node)
+            ):
+                return True
+        return False
+
+    def distance2(self, node: int, x: float, y: float) -> float:
+        dx = max(self.min_x[node] - x, 0.0, x - self.max_x[node])
+        dy = max(self.min_y[node] - y, 0.0, y - self.max_y[node])
+        return dx * dx + dy * dy
+
+    def farthest_distance2(self, node: int, x: float, y: float) -> float:
+        dx = max(x - self.min_x[node], self.max_x[node] - x)
+        dy = max(y - self.min_y[node], self.max_y[node] - y)
+        return dx * dx + dy * dy
+
+    # Best-first search: nodes are taken from a heap ordered by the distance to their boxes and
+    # the k best points found so far are kept in a bounded max-heap (distances negated).
+    def nearest(self, x: float, y: float, k: int) -> List[int]:
+        if k <= 0 or self.node_count == 0:
+            return []
+        xs, ys = self.xs, self.ys
+        best: List[Tuple[float, int]] = []
+        frontier: List[Tuple[float, int]] = [(self.distance2(0, x, y), 0)]
+        while len(frontier) > 0:
+            node_distance, node = heappop(frontier)
+            if len(best) == k and node_distance > -best[0][0]:
+                break
+            if self.is_leaf(node):
+                for i in self.node_indices(node):
+                    dx, dy = xs[i] - x, ys[i] - y
+                    distance = dx * dx + dy * dy
+                    if len(best) < k:
+                        heappush(best, (-distance, -i))
+                    elif distance < -best[0][0]:
+                        heapreplace(best, (-distance, -i))
+                continue
+            for child in self.children(node):
+                if self.size[child] == 0:
+                    continue
+                child_distance = self.distance2(child, x, y)
+                if len(best) < k or child_distance <= -best[0][0]:
+                    heappush(frontier, (child_distance, child))
+        return [-i for _, i in sorted(best, reverse=True)]
+
+    def within_radius(self, x: float, y: float, radius: float) -> array:
+        result = array('q')
+        if radius < 0 or self.node_count == 0:
+            return result
+        radius2 = radius * radius
+        xs, ys = self.xs, self.ys
+        stack = [0]
+        while len(stack) > 0:
+            node = stack.pop()
+            if self.distance2(node, x, y) > radius2:
+                continue
+            if self.farthest_distance2(node, x, y) <= radius2:
+                result.extend(self.node_indices(node))
+            elif self.is_leaf(node):
+                for i in self.node_indices(node):
+                    dx, dy = xs[i] - x, ys[i] - y
+                    if dx * dx + dy * dy <= radius2:
+                        result.append(i)
+            else:
+                stack.extend(reversed(self.children(node)))
+        return result
+
+    def nearest_many(self, points: PointSource, k: int) -> Tuple[array, array]:
+        query_xs, query_ys = as_coordinates(points)
+        indices = array('q')
+        offsets = array('q', [0])
+        for x, y in zip(query_xs, query_ys):
+            indices.extend(self.nearest(x, y, k))
+            offsets.append(len(indices))
+        return indices, offsets
+
+    def within_radius_many(self, points: PointSource, radius: float) -> Tuple[array, array]:
+        query_xs, query_ys = as_coordinates(points)
+        hits: List[array] = [array('q') for _ in query_xs]
+        if len(hits) > 0 and radius >= 0 and self.node_count > 0:
+            self.__within_radius_many(range(len(hits)), query_xs, query_ys, radius * radius, hits)
+
+        indices = array('q')
+        offsets = array('q', [0])
+        for found in hits:
+            indices.extend(found)
+            offsets.append(len(indices))
+        return indices, offsets
+
+    def __within_radius_many(self, active: Sequence[int], query_xs: array, query_ys: array, radius2: float,
+                             hits: List[array]):
+        stack = [(0, active)]
+        while len(stack) > 0:
+            node, active = stack.pop()
+            partial: List[int] = []
+            indices: Optional[array] = None
+            for q in active:
+                x, y = query_xs[q], query_ys[q]
+                if self.distance2(node, x, y) > radius2:
+                    continue
+                if self.farthest_distance2(node, x, y) <= radius2:
+                    if indices is None:
+                        indices = self.node_indices(node)
+                    hits[q].extend(indices)
+                else:
+                    partial.append(q)
+            if len(partial) == 0:
+                continue
+
+            if self.is_leaf(node):
+                xs, ys = self.xs, self.ys
+                leaf = self.node_indices(node)
+                for q in partial:
+                    x, y = query_xs[q], query_ys[q]
+                    hits[q].extend([
+                        i for i in leaf if (xs[i] - x) * (xs[i] - x) + (ys[i] - y) * (ys[i] - y) <= radius2
+                    ])
+                continue
+            stack.extend((child, partial) for child in reversed(self.children(node)))
+
+    def search_many(self, rectangles: RectangleSource) -> Tuple[array, array]:
+        queries = as_query_boxes(rectangles)
+        hits: List[array] = [array('q') for _ in queries]
+        if len(queries) > 0 and self.node_count > 0:
+            self.__search_many(range(len(queries)), queries, hits)
+
+        indices = array('q')
+        offsets = array('q', [0])
+        for found in hits:
+            indices.extend(found)
+            offsets.append(len(indices))
+        return indices, offsets
+
+    # Every visit classifies the whole batch of queries still alive at a node, so the interpreter
+    # pays for one visit per node instead of one per (node, query) pair.
+    def __search_many(self, active: Sequence[int], queries: List[QueryBox], hits: List[array]):
+        stack = [(0, active)]
+        while len(stack) > 0:
+            node, active = stack.pop()
+            min_x, max_x, min_y, max_y = self.min_x[node], self.max_x[node], self.min_y[node], self.max_y[node]
+            partial: List[int] = []
+            indices: Optional[array] = None
+            for q in active:
+                q_min_x, q_max_x, q_min_y, q_max_y = queries[q]
+                if max_x <= q_min_x or min_x > q_max_x or max_y <= q_min_y or min_y > q_max_y:
+                    continue
+                if q_min_x < min_x and max_x <= q_max_x and q_min_y < min_y and max_y <= q_max_y:
+                    if indices is None:
+                        indices = self.node_indices(node)
+                    hits[q].extend(indices)
+                else:
+                    partial.append(q)
+            if len(partial) == 0:
+                continue
+
+            if self.is_leaf(node):
+                xs, ys = self.xs, self.ys
+                leaf = self.node_indices(node)
+                for q in partial:
+                    q_min_x, q_max_x, q_min_y, q_max_y = queries[q]
+                    hits[q].extend([i for i in leaf if q_min_x < xs[i] <= q_max_x and q_min_y < ys[i] <= q_max_y])
+                continue
+            stack.extend((child, partial) for child in reversed(self.children(node)))
+
+    def leaf_hits(self, node: int, rect: Rectangle) -> array:
+        xs, ys = self.xs, self.ys
+        min_x, max_x, min_y, max_y = rect.min_x, rect.max_x, rect.min_y, rect.max_y
+        return array('q', [
+            i for i in self.perm[self.start[node]:self.end[node]]
+            if min_x < xs[i] <= max_x and min_y < ys[i] <= max_y
+        ])
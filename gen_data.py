@@ -35,3 +35,31 @@ def gen_point_clusters(
             ) for _ in range(points_per_cluster)
         ])
     return result
+
+
+# GPS-like fixes piling up at a few spots; jitter > 0 makes them near-duplicates instead of exact ones
+def gen_point_duplicates(
+        scope: Tuple[float, float] = (0, 100),
+        n: int = 100,
+        spot_amount: int = 5,
+        jitter: float = 0
+) -> List[Point]:
+    spots = [(uniform(scope[0], scope[1]), uniform(scope[0], scope[1])) for _ in range(spot_amount)]
+    return [
+        (spots[i % spot_amount][0] + uniform(-jitter, jitter), spots[i % spot_amount][1] + uniform(-jitter, jitter))
+        for i in range(n)
+    ]
+
+
+# uniform points squeezed towards the lower left corner, the larger the exponent the stronger the skew
+def gen_point_skewed(scope: Tuple[float, float] = (0, 100), n: int = 100, exponent: float = 3) -> List[Point]:
+    width = scope[1] - scope[0]
+    return [(scope[0] + width * uniform(0, 1) ** exponent, scope[0] + width * uniform(0, 1) ** exponent)
+            for _ in range(n)]
+
+
+# a square query covering the given fraction of the scope's area, placed uniformly within the scope
+def gen_rect_of_area(scope: Tuple[float, float] = (0, 100), fraction: float = 0.01) -> Rectangle:
+    side = (scope[1] - scope[0]) * fraction ** 0.5
+    min_x, min_y = uniform(scope[0], scope[1] - side), uniform(scope[0], scope[1] - side)
+    return Rectangle(min_x, min_x + side, min_y, min_y + side)
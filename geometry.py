@@ -2,7 +2,6 @@ from __future__ import annotations
 
 from enum import Enum, unique
 from typing import Tuple, List, Optional
-from math import inf
 
 Point = Tuple[float, float]
 Line = Tuple[Point, Point]
@@ -15,6 +14,8 @@ class AxisType(Enum):
 
 
 class Rectangle:
+    __slots__ = ('min_x', 'max_x', 'min_y', 'max_y')
+
     def __init__(self, min_x: float, max_x: float, min_y: float, max_y: float):
         self.min_x: float = min_x
         self.max_x: float = max_x
@@ -25,6 +26,20 @@ class Rectangle:
                 'incorrect parameters for rectangle construction: {}, {}, {}, {}'.format(min_x, max_x, min_y, max_y)
             )
 
+    # The predicates below compare coordinates directly and allocate nothing, the operators are
+    # defined through them. Like &, intersects needs an overlap of positive area.
+    def contains(self, other: Rectangle) -> bool:
+        return (
+                self.min_x <= other.min_x and other.max_x <= self.max_x and
+                self.min_y <= other.min_y and other.max_y <= self.max_y
+        )
+
+    def intersects(self, other: Rectangle) -> bool:
+        return (
+                self.min_x < other.max_x and other.min_x < self.max_x and
+                self.min_y < other.max_y and other.min_y < self.max_y
+        )
+
     def __and__(self, other: Rectangle):
         if not isinstance(other, Rectangle):
             return None
@@ -55,34 +70,42 @@ class Rectangle:
     def __le__(self, other: Rectangle):
         if not isinstance(other, Rectangle):
             return False
-        return self == self & other
+        return other.contains(self)
 
     def __lt__(self, other: Rectangle):
         if not isinstance(other, Rectangle):
             return False
-        return self <= other and self != other
+        return other.contains(self) and self != other
 
     def __ge__(self, other: Rectangle):
         if not isinstance(other, Rectangle):
             return False
-        return other == self & other
+        return self.contains(other)
 
     def __gt__(self, other: Rectangle):
         if not isinstance(other, Rectangle):
             return False
-        return self >= other and self != other
+        return self.contains(other) and self != other
 
+    # The part of the rectangle on one side of a line, without building the half-plane first.
     def less_than(self, line: float, axis: AxisType) -> Optional[Rectangle]:
         if axis is AxisType.X:
-            return self & Rectangle(-inf, inf, -inf, line)
-        else:
-            return self & Rectangle(-inf, line, -inf, inf)
+            if line >= self.max_y:
+                return self
+            return Rectangle(self.min_x, self.max_x, self.min_y, line) if self.min_y < line else None
+        if line >= self.max_x:
+            return self
+        return Rectangle(self.min_x, line, self.min_y, self.max_y) if self.min_x < line else None
 
     def greater_than(self, line: float, axis: AxisType) -> Optional[Rectangle]:
+        line += 10 ** -10
         if axis is AxisType.X:
-            return self & Rectangle(-inf, inf, line + 10 ** -10, inf)
-        else:
-            return self & Rectangle(line + 10 ** -10, inf, -inf, inf)
+            if line <= self.min_y:
+                return self
+            return Rectangle(self.min_x, self.max_x, line, self.max_y) if line < self.max_y else None
+        if line <= self.min_x:
+            return self
+        return Rectangle(line, self.max_x, self.min_y, self.max_y) if line < self.max_x else None
 
     def point_inside(self, point: Point) -> bool:
         x, y = point
@@ -1,162 +1,375 @@
-from typing import List, Callable, Optional, Tuple, Union
-from geometry import Point, Line, Rectangle, rectangle_from_points, AxisType
-from draw_tool import Scene, PointsCollection, LinesCollection
-from random import sample
-
-VisualizingFrame = Tuple[List[Point], List[Line]]
-_COLOR_SEARCHED_RECT = "black"
-_COLOR_CONSIDERED_NOW = "red"
-_COLOR_FOUND_POINT = "red"
-_COLOR_DIVIDER = "yellow"
-
-
-class _Node:
-    def __init__(self, points: List[Point], region: Optional[Rectangle] = None):
-        self.points: List[Point] = points
-        self.is_leaf: bool = len(points) == 1
-
-        self.region: Rectangle = region if region is not None else rectangle_from_points(points)
-
-        x_coords = list(map(lambda p: p[0], points))
-        x_diff = max(x_coords) - min(x_coords)
-        y_coords = list(map(lambda p: p[1], points))
-        y_diff = max(y_coords) - min(y_coords)
-        self.division_axis_type: AxisType = AxisType.Y if x_diff >= y_diff else AxisType.X
-        self.__point_comparing_key: Callable[[Point], float] = \
-            (lambda p: p[0]) if self.division_axis_type is AxisType.Y else (lambda p: p[1])
-
-        median = self.__median()
-        self.dividing_line: float = median if not self.is_leaf else None
-
-        left_points = list(filter(lambda p: self.__point_comparing_key(p) <= median, points))
-        self.left = _Node(
-            left_points,
-            region=self.region.less_than(median, self.division_axis_type),
-        ) if (not self.is_leaf) and len(left_points) > 0 else None
-
-        right_points = list(filter(lambda p: self.__point_comparing_key(p) > median, points))
-        self.right = _Node(
-            right_points,
-            region=self.region.greater_than(median, self.division_axis_type),
-        ) if (not self.is_leaf) and len(right_points) > 0 else None
-
-    def __median(self) -> float:
-        chosen: List[Point]
-        if len(self.points) > 1000:
-            chosen = sample(self.points, 1000)
+from array import array
+from bisect import bisect_right
+from enum import Enum, unique
+from functools import partial
+from math import inf
+from typing import Iterator, List, Optional, Sequence, Tuple, Union, TYPE_CHECKING
+from geometry import Point, Line, Rectangle, AxisType
+from flat_tree import FlatTree, PointSource, SearchMode, as_coordinates
+from search_tree import SearchTree
+from tracing import Tracer
+
+if TYPE_CHECKING:
+    from draw_tool import Scene
+
+MEDIAN_SAMPLE_SIZE = 1000
+_SURFACE_AREA_CANDIDATES = 32
+# a subtree is rebuilt once one of its children holds more than this fraction of its points,
+# and the whole tree once it shrinks below this fraction of its size after the last rebuild
+_BALANCE = 0.75
+# A subtree has to grow by this factor since it was built before it is rebuilt. Rebuilding cannot
+# even out a leaf of copies of one point, nor the uneven splits of SLIDING_MIDPOINT and SURFACE_AREA,
+# so without this those subtrees would be rebuilt on every insert instead of once per doubling.
+_GROWTH = 2
+_FILE_KIND = 'kd_tree'
+
+
+# division_axis holds AxisType values: AxisType.Y is a vertical dividing line (points compared by x),
+# AxisType.X a horizontal one (points compared by y). Points with key <= dividing_line go to the
+# first child, the rest to the second one. built_size is the number of points of the node when
+# it was last built.
+class KDArrays(FlatTree):
+    COLUMNS = FlatTree.COLUMNS + ('dividing_line', 'division_axis', 'built_size')
+
+    def __init__(self, xs: array, ys: array, leaf_size: int = 1, perm: Optional[array] = None):
+        super().__init__(xs, ys, leaf_size, perm)
+        self.dividing_line: array = array('d')
+        self.division_axis: array = array('b')
+        self.built_size: array = array('q')
+
+    def add_node(self, start: int, end: int, min_x: float, max_x: float, min_y: float, max_y: float) -> int:
+        self.dividing_line.append(0.0)
+        self.division_axis.append(0)
+        self.built_size.append(end - start)
+        return super().add_node(start, end, min_x, max_x, min_y, max_y)
+
+    def split_columns(self) -> List[array]:
+        return super().split_columns() + [self.dividing_line, self.division_axis]
+
+    def get_divider_line(self, node: int) -> Line:
+        line = self.dividing_line[node]
+        if self.division_axis[node] == AxisType.X.value:
+            return (self.min_x[node], line), (self.max_x[node], line)
         else:
-            chosen = self.points
-        temp = sorted(list(map(self.__point_comparing_key, chosen)))
-        if len(temp) % 2 == 1:
-            return temp[len(temp) // 2]
+            return (line, self.min_y[node]), (line, self.max_y[node])
+
+
+@unique
+class SplitPolicy(Enum):
+    # median of a strided sample of at most MEDIAN_SAMPLE_SIZE coordinates
+    SAMPLED_MEDIAN = 0
+    # median of all of the coordinates, found by selection instead of sorting
+    EXACT_MEDIAN = 1
+    # middle of the node's region, slid to the nearest point when one side would be left empty
+    SLIDING_MIDPOINT = 2
+    # the candidate line minimising the sum of points times region area over both halves
+    SURFACE_AREA = 3
+
+
+def sampled_median(coords: List[float]) -> float:
+    chosen: List[float]
+    if len(coords) > MEDIAN_SAMPLE_SIZE:
+        chosen = coords[::len(coords) // MEDIAN_SAMPLE_SIZE]
+    else:
+        chosen = coords
+    temp = sorted(chosen)
+    if len(temp) % 2 == 1:
+        return temp[len(temp) // 2]
+    else:
+        return (temp[len(temp) // 2] + temp[(len(temp) - 1) // 2]) / 2
+
+
+# Quickselect around a median of three pivot. After too many rounds that barely shrink the list
+# it sorts what is left instead, which bounds the worst case like introselect does.
+def _select(values: List[float], k: int) -> float:
+    rounds = 2 * len(values).bit_length()
+    while len(values) > 16 and rounds > 0:
+        pivot = sorted((values[0], values[len(values) // 2], values[-1]))[1]
+        lower = [v for v in values if v < pivot]
+        if k < len(lower):
+            values = lower
+        else:
+            k -= len(lower)
+            equal = values.count(pivot)
+            if k < equal:
+                return pivot
+            k -= equal
+            values = [v for v in values if v > pivot]
+        rounds -= 1
+    return sorted(values)[k]
+
+
+def _sliding_midpoint(coords: List[float], low: float, high: float, region_low: float, region_high: float) \
+        -> float:
+    middle = (region_low + region_high) / 2
+    if middle < low:
+        return low
+    if middle >= high:
+        return max(c for c in coords if c < high)
+    return middle
+
+
+def _surface_area(coords: List[float], region_low: float, region_high: float) -> float:
+    sample = sorted(coords if len(coords) <= MEDIAN_SAMPLE_SIZE else coords[::len(coords) // MEDIAN_SAMPLE_SIZE])
+    best_line, best_cost = sample[(len(sample) - 1) // 2], inf
+    for j in range(1, _SURFACE_AREA_CANDIDATES):
+        line = sample[j * len(sample) // _SURFACE_AREA_CANDIDATES]
+        left = bisect_right(sample, line)
+        # the halves share the extent along the other axis, so their lengths stand in for areas
+        cost = left * (line - region_low) + (len(sample) - left) * (region_high - line)
+        if left < len(sample) and cost < best_cost:
+            best_line, best_cost = line, cost
+    return best_line
+
+
+def _build(tree: KDArrays, node: int, levels: Optional[int] = None,
+           policy: SplitPolicy = SplitPolicy.SAMPLED_MEDIAN):
+    # the first child is popped right after its parent, so nodes are allocated in depth-first order
+    stack = [(node, levels)]
+    while len(stack) > 0:
+        node, levels = stack.pop()
+        start, end = tree.start[node], tree.end[node]
+        if end - start <= tree.leaf_size or levels == 0:
+            continue
+        segment = tree.perm[start:end]
+        x_coords = [tree.xs[i] for i in segment]
+        y_coords = [tree.ys[i] for i in segment]
+        min_x, max_x, min_y, max_y = min(x_coords), max(x_coords), min(y_coords), max(y_coords)
+        if min_x == max_x and min_y == max_y:
+            continue
+
+        axis: AxisType
+        region = tree.min_x[node], tree.max_x[node], tree.min_y[node], tree.max_y[node]
+        if max_x - min_x >= max_y - min_y:
+            axis, keys, coords, low, high, region_low, region_high = \
+                AxisType.Y, tree.xs, x_coords, min_x, max_x, region[0], region[1]
         else:
-            return (temp[len(temp) // 2] + temp[(len(temp) - 1) // 2]) / 2
+            axis, keys, coords, low, high, region_low, region_high = \
+                AxisType.X, tree.ys, y_coords, min_y, max_y, region[2], region[3]
 
-    def get_divider_line(self) -> Line:
-        if self.division_axis_type is AxisType.X:
-            return (self.region.min_x, self.dividing_line), (self.region.max_x, self.dividing_line)
+        if policy is SplitPolicy.EXACT_MEDIAN:
+            median = _select(coords, (len(coords) - 1) // 2)
+        elif policy is SplitPolicy.SLIDING_MIDPOINT:
+            median = _sliding_midpoint(coords, low, high, region_low, region_high)
+        elif policy is SplitPolicy.SURFACE_AREA:
+            median = _surface_area(coords, region_low, region_high)
         else:
-            return (self.dividing_line, self.region.min_y), (self.dividing_line, self.region.max_y)
+            median = sampled_median(coords)
+        left = array('q', [i for i in segment if keys[i] <= median])
+        if len(left) == 0 or len(left) == len(segment):
+            # the sample hit a run of equal coordinates, fall back to the middle of the extent
+            median = (low + high) / 2 if (low + high) / 2 < high else low
+            left = array('q', [i for i in segment if keys[i] <= median])
+        right = array('q', [i for i in segment if keys[i] > median])
+        tree.perm[start:end] = left + right
+
+        first = _split(tree, node, axis, median, start + len(left))
+        levels = levels - 1 if levels is not None else None
+        stack.append((first + 1, levels))
+        stack.append((first, levels))
+
+
+def _split(tree: KDArrays, node: int, axis: AxisType, line: float, middle: int) -> int:
+    start, end = tree.start[node], tree.end[node]
+    tree.dividing_line[node] = line
+    tree.division_axis[node] = axis.value
+    region = tree.min_x[node], tree.max_x[node], tree.min_y[node], tree.max_y[node]
+    if axis is AxisType.Y:
+        first = tree.add_node(start, middle, region[0], line, region[2], region[3])
+        tree.add_node(middle, end, line, region[1], region[2], region[3])
+    else:
+        first = tree.add_node(start, middle, region[0], region[1], region[2], line)
+        tree.add_node(middle, end, region[0], region[1], line, region[3])
+    tree.set_children(node, first, 2)
+    return first
 
-    def get_lines_from_node(self) -> Tuple[List[Line], List[Line]]:
-        rectangle: List[Line] = self.region.get_lines() if self.region is not None else []
-        if self.is_leaf:
-            return rectangle, []
-        return rectangle, [self.get_divider_line()]
 
+# Builds the same tree as _build with SplitPolicy.EXACT_MEDIAN in O(n log n): the points are
+# sorted by x and by y once, and every split hands each child its part of both orders. The split
+# axis order is cut at the median, the other one is filtered through a mark per point, so no
+# level sorts or rescans coordinates. Points of a leaf end up in perm ordered by x.
+def _build_presorted(tree: KDArrays, node: int, levels: Optional[int] = None):
+    segment = tree.perm[tree.start[node]:tree.end[node]]
+    xs, ys = tree.xs, tree.ys
+    marks = bytearray(len(xs))
+    stack = [(node, array('q', sorted(segment, key=xs.__getitem__)), array('q', sorted(segment, key=ys.__getitem__)),
+              levels)]
+    while len(stack) > 0:
+        node, by_x, by_y, levels = stack.pop()
+        start, end = tree.start[node], tree.end[node]
+        if end - start <= tree.leaf_size or levels == 0:
+            tree.perm[start:end] = by_x
+            continue
+        min_x, max_x, min_y, max_y = xs[by_x[0]], xs[by_x[-1]], ys[by_y[0]], ys[by_y[-1]]
+        if min_x == max_x and min_y == max_y:
+            tree.perm[start:end] = by_x
+            continue
 
-def _kd_search(node: _Node, rectangle: Rectangle, frames: Optional[List[VisualizingFrame]] = None) -> List[Point]:
-    if node.is_leaf:
-        if rectangle.point_inside(node.points[0]):
-            if frames is not None:
-                frames.append((node.points, node.get_lines_from_node()[0]))
-            return node.points
+        if max_x - min_x >= max_y - min_y:
+            axis, keys, ordered, other, low, high = AxisType.Y, xs, by_x, by_y, min_x, max_x
         else:
-            if frames is not None:
-                frames.append(([], node.get_lines_from_node()[0]))
-            return []
-    result = []
-
-    if frames is not None:
-        frames.append(([], node.get_lines_from_node()[0]))
-
-    def search_child(child: _Node) -> List[Point]:
-        if child.region <= rectangle:
-            if frames is not None:
-                frames.append((child.points, child.get_lines_from_node()[0]))
-            return child.points
-        elif child.region & rectangle is not None:
-            return _kd_search(child, rectangle, frames=frames)
+            axis, keys, ordered, other, low, high = AxisType.X, ys, by_y, by_x, min_y, max_y
+        median = keys[ordered[(len(ordered) - 1) // 2]]
+        if median == high:
+            median = (low + high) / 2 if (low + high) / 2 < high else low
+        first_above, last = 0, len(ordered)
+        while first_above < last:
+            probe = (first_above + last) // 2
+            if keys[ordered[probe]] <= median:
+                first_above = probe + 1
+            else:
+                last = probe
+        left, right = ordered[:first_above], ordered[first_above:]
+        for i in left:
+            marks[i] = 1
+        other_left = array('q', [i for i in other if marks[i]])
+        other_right = array('q', [i for i in other if not marks[i]])
+        for i in left:
+            marks[i] = 0
+
+        first = _split(tree, node, axis, median, start + len(left))
+        levels = levels - 1 if levels is not None else None
+        if axis is AxisType.Y:
+            stack.append((first + 1, right, other_right, levels))
+            stack.append((first, left, other_left, levels))
         else:
-            return []
-
-    if node.right is not None:
-        result.extend(search_child(node.left))
-    if node.left is not None:
-        result.extend(search_child(node.right))
-    if frames is not None:
-        frames.append((result, node.get_lines_from_node()[0]))
-    return result
-
-
-def _get_lines_from_subtree(node: _Node) -> Tuple[List[Line], List[Line]]:
-    rectangles, dividers = node.get_lines_from_node()
-
-    def get_from_child(child: _Node):
-        if child is not None:
-            child_rects, child_divs = _get_lines_from_subtree(child)
-            rectangles.extend(child_rects)
-            dividers.extend(child_divs)
-
-    if node is not None:
-        get_from_child(node.left)
-        get_from_child(node.right)
-    return rectangles, dividers
-
-
-class KDTree:
-    def __init__(self, points: List[Point]):
-        self.__root: _Node = _Node(points)
-        self.__rectangles, self.__dividers = _get_lines_from_subtree(self.__root)
-
-    def search(self, x_min: float, x_max: float, y_min: float, y_max: float, visualize: bool = False) \
-            -> Union[List[Point], Tuple[List[Point], List[Scene]]]:
-        rectangle = Rectangle(x_min, x_max, y_min, y_max) & self.__root.region
-        if not visualize:
-            return _kd_search(self.__root, rectangle)
-
-        frames: List[VisualizingFrame] = []
-        points = _kd_search(self.__root, rectangle, frames=frames)
-        scenes: List[Scene] = [self.get_visualized()]
-
-        def scene_from_frame(frame: VisualizingFrame) -> Scene:
-            vis_points, vis_lines = frame
-            return Scene(
-                points=[
-                    PointsCollection(self.__root.points),
-                    PointsCollection(vis_points, color=_COLOR_FOUND_POINT)
-                ],
-                lines=[
-                    LinesCollection(self.__rectangles),
-                    LinesCollection(self.__dividers, color=_COLOR_DIVIDER),
-                    LinesCollection(rectangle.get_lines(), color=_COLOR_SEARCHED_RECT),
-                    LinesCollection(vis_lines, color=_COLOR_CONSIDERED_NOW)
-                ]
+            stack.append((first + 1, other_right, right, levels))
+            stack.append((first, other_left, left, levels))
+
+
+# Builds the kd-tree of the given points with the SAMPLED_MEDIAN policy and appends it below
+# `node` of `tree`, whose box it keeps. Point ranges of the new nodes start at point_offset.
+# Returns the order the points take in those ranges. This is the entry point of builders that
+# split the top levels of a tree themselves, such as the disk-backed one.
+def build_subtree(tree: KDArrays, node: int, xs: array, ys: array, point_offset: int = 0) -> array:
+    local = KDArrays(xs, ys, tree.leaf_size)
+    local.add_node(0, len(xs), tree.min_x[node], tree.max_x[node], tree.min_y[node], tree.max_y[node])
+    _build(local, 0)
+    local.tighten(0)
+    tree.append_subtree(node, local.columns(), point_offset)
+    return local.perm
+
+
+class KDTree(SearchTree):
+    ARRAYS = KDArrays
+    FILE_KIND = _FILE_KIND
+    NAME = 'kd-tree'
+
+    def __init__(self, points: PointSource, leaf_size: int = 1, workers: int = 1,
+                 ids: Optional[Sequence[int]] = None, split_policy: SplitPolicy = SplitPolicy.SAMPLED_MEDIAN,
+                 presorted: bool = False, values: Optional[Sequence[float]] = None):
+        self.build(*as_coordinates(points), leaf_size, workers, ids, split_policy, presorted, values)
+
+    def build(self, xs: array, ys: array, leaf_size: int = 1, workers: int = 1, ids: Optional[Sequence[int]] = None,
+              split_policy: SplitPolicy = SplitPolicy.SAMPLED_MEDIAN, presorted: bool = False,
+              values: Optional[Sequence[float]] = None):
+        if presorted and split_policy is not SplitPolicy.EXACT_MEDIAN:
+            raise ValueError(
+                'the presorted build splits at exact medians, it needs {}'.format(SplitPolicy.EXACT_MEDIAN)
             )
+        self.__split_policy: SplitPolicy = split_policy
+        self.__presorted: bool = presorted
+        self.__max_size: int = len(xs)
+
+        def split(tree: KDArrays):
+            if workers > 1:
+                from parallel_build import build_parallel
+
+                # enough subtrees below the top levels to keep every worker busy
+                build = _build_presorted if presorted else partial(_build, policy=split_policy)
+                build_parallel(tree, build, workers, levels=(4 * workers - 1).bit_length())
+            elif presorted:
+                _build_presorted(tree, 0)
+            else:
+                _build(tree, 0, policy=split_policy)
+
+        self.build_tree(xs, ys, leaf_size, ids, values, split)
+
+    def settings(self) -> Tuple[int, ...]:
+        return self.__split_policy.value, int(self.__presorted)
+
+    def load_settings(self, settings: Tuple[int, ...]):
+        self.__split_policy = SplitPolicy(settings[0])
+        self.__presorted = bool(settings[1])
+        self.__max_size = len(self.tree)
+
+    def insert_index(self, index: int, value: Optional[float]):
+        tree = self.tree
+        x, y = tree.xs[index], tree.ys[index]
+        if len(tree) == 0:
+            tree.reset(array('q', [index]))
+            tree.tighten(0)
+            self.__max_size = max(self.__max_size, 1)
+            return
+
+        node = 0
+        path = [node]
+        tree.expand(node, x, y, value)
+        while not tree.is_leaf(node):
+            key = x if tree.division_axis[node] == AxisType.Y.value else y
+            node = tree.child_first[node] if key <= tree.dividing_line[node] else tree.child_first[node] + 1
+            tree.expand(node, x, y, value)
+            path.append(node)
+        tree.append_to_leaf(path, index)
+        if not tree.holds_copies(node):
+            _build(tree, node, policy=self.__split_policy)
+            tree.tighten(node)
+
+        for node in path:
+            if tree.is_leaf(node):
+                break
+            if tree.size[node] >= _GROWTH * tree.built_size[node] and \
+                    max(tree.size[child] for child in tree.children(node)) > _BALANCE * tree.size[node]:
+                tree.collapse(node)
+                tree.built_size[node] = tree.size[node]
+                _build(tree, node, policy=self.__split_policy)
+                tree.tighten(node)
+                break
+        self.__max_size = max(self.__max_size, len(tree))
+        if tree.needs_compaction():
+            self.__rebuild()
+
+    def after_remove(self, path: List[int], index: int):
+        if len(self.tree) < _BALANCE * self.__max_size or self.tree.needs_compaction():
+            self.__rebuild()
+        else:
+            self.tree.tighten_path(path, index)
+
+    def __rebuild(self):
+        tree = self.tree
+        tree.reset(tree.node_indices(0))
+        if self.__presorted:
+            _build_presorted(tree, 0)
+        else:
+            _build(tree, 0, policy=self.__split_policy)
+        tree.tighten(0)
+        self.__max_size = len(tree)
+
+    def dividers(self) -> List[Line]:
+        return [self.tree.get_divider_line(node) for node in range(self.tree.node_count) if not self.tree.is_leaf(node)]
+
+    def search(self, x_min: float, x_max: float, y_min: float, y_max: float, visualize: bool = False,
+               mode: SearchMode = SearchMode.LIST, tracer: Optional[Tracer] = None) \
+            -> Union[List[Point], Tuple[List[Point], Sequence['Scene']], Iterator[Point], array, int, bool]:
+        rectangle = Rectangle(x_min, x_max, y_min, y_max)
+        if visualize:
+            return self.visualized_search(rectangle, mode, tracer)
+        return self.range_search(rectangle, mode, tracer)
+
+    search_aggregate = SearchTree.aggregate
+    search_many = SearchTree.range_search_many
+
+    def nearest(self, point: Point, k: int = 1) -> List[Point]:
+        return self.tree.points(self.tree.nearest(point[0], point[1], k))
+
+    def within_radius(self, point: Point, radius: float) -> List[Point]:
+        return self.tree.points(self.tree.within_radius(point[0], point[1], radius))
 
-        scenes.extend(map(scene_from_frame, frames))
-        return points, scenes
+    def nearest_many(self, points: PointSource, k: int = 1) -> Tuple[array, array]:
+        return self.tree.ids_of_many(*self.tree.nearest_many(points, k))
 
-    def get_visualized(self) -> Scene:
-        return Scene(
-            points=[
-                PointsCollection(self.__root.points)
-            ],
-            lines=[
-                LinesCollection(self.__rectangles),
-                LinesCollection(self.__dividers, color=_COLOR_DIVIDER),
-            ]
-        )
+    def within_radius_many(self, points: PointSource, radius: float) -> Tuple[array, array]:
+        return self.tree.ids_of_many(*self.tree.within_radius_many(points, radius))
 
 
 if __name__ == "__main__":
@@ -175,3 +388,4 @@ if __name__ == "__main__":
     Tree = KDTree(Points)
     print(Points)
     print(Tree.search(1, 4, 1, 4))
+    print(KDTree(array('d', [c for p in Points for c in p])).search(0, 4, 0, 4))
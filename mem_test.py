@@ -1,24 +1,48 @@
+import os
 import sys
+import tempfile
 import tracemalloc
+from array import array
 from typing import Callable
 from kd_tree import KDTree
 from quadtree import Quadtree
 from gen_data import *
+from point_files import write_coordinates
 
+FILE_FORMATS = ('csv', 'raw', 'npy')
 
-def test_kd_buildup(points: List[Point]) -> float:
+
+def test_kd_buildup(points: List[Point], leaf_size: int = 1) -> float:
     tracemalloc.start()
     starting_mem, _ = tracemalloc.get_traced_memory()
-    tree = KDTree(points)
+    tree = KDTree(points, leaf_size=leaf_size)
     current, peak = tracemalloc.get_traced_memory()
     tracemalloc.stop()
     return peak - starting_mem
 
 
-def test_quadtree_buildup(points: List[Point]) -> float:
+def test_quadtree_buildup(points: List[Point], leaf_size: int = 1) -> float:
+    tracemalloc.start()
+    starting_mem, _ = tracemalloc.get_traced_memory()
+    tree = Quadtree(points, leaf_size=leaf_size)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return peak - starting_mem
+
+
+def test_kd_from_file(path: str, leaf_size: int = 1) -> float:
     tracemalloc.start()
     starting_mem, _ = tracemalloc.get_traced_memory()
-    tree = Quadtree(points)
+    tree = KDTree.from_file(path, leaf_size=leaf_size)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return peak - starting_mem
+
+
+def test_quadtree_from_file(path: str, leaf_size: int = 1) -> float:
+    tracemalloc.start()
+    starting_mem, _ = tracemalloc.get_traced_memory()
+    tree = Quadtree.from_file(path, leaf_size=leaf_size)
     _, peak = tracemalloc.get_traced_memory()
     tracemalloc.stop()
     return peak - starting_mem
@@ -34,27 +58,64 @@ class Tester:
 
     def print_tests_csv(
             self,
-            buildup_tester: Callable[[List[Point]], float],
-            filename: str
+            buildup_tester: Callable[[List[Point], int], float],
+            filename: str,
+            leaf_sizes: List[int] = (1,)
     ):
-        buildup_results: List[float] = []
-        total_amount = len(self.n_values) * len(self.test_points[0])
-        for i in range(len(self.test_points)):
-            result = []
-            for j in range(len(self.test_points[0])):
-                sys.stdout.write("\rTest {}/{}".format(i * len(self.test_points[0]) + j + 1, total_amount))
-                sys.stdout.flush()
-                result.append(buildup_tester(self.test_points[i][j]))
-            buildup_results.append(sum(result)/len(self.test_points[0]))
+        buildup_results: List[List[float]] = []
+        total_amount = len(leaf_sizes) * len(self.n_values) * len(self.test_points[0])
+        for leaf_size in leaf_sizes:
+            leaf_size_results: List[float] = []
+            for i in range(len(self.test_points)):
+                result = []
+                for j in range(len(self.test_points[0])):
+                    test_number = (len(buildup_results) * len(self.n_values) + i) * len(self.test_points[0]) + j + 1
+                    sys.stdout.write("\rTest {}/{}".format(test_number, total_amount))
+                    sys.stdout.flush()
+                    result.append(buildup_tester(self.test_points[i][j], leaf_size))
+                leaf_size_results.append(sum(result)/len(self.test_points[0]))
+            buildup_results.append(leaf_size_results)
 
         with open(filename + '_buildup_memtest.csv', 'w') as file:
-            file.write('n;memory\n')
-            for i in range(len(buildup_results)):
-                file.write(str(self.n_values[i]) + ';' + str(buildup_results[i]) + '\n')
+            file.write('n;leaf_size;memory\n')
+            for k in range(len(leaf_sizes)):
+                for i in range(len(self.n_values)):
+                    file.write(
+                        str(self.n_values[i]) + ';' + str(leaf_sizes[k]) + ';' + str(buildup_results[k][i]) + '\n'
+                    )
 
-    def print_tests_both_trees_csv(self, base_filename: str):
-        self.print_tests_csv(test_quadtree_buildup, base_filename + '_quadtree')
-        self.print_tests_csv(test_kd_buildup, base_filename + '_kd_tree')
+    def print_tests_both_trees_csv(self, base_filename: str, leaf_sizes: List[int] = (1,)):
+        self.print_tests_csv(test_quadtree_buildup, base_filename + '_quadtree', leaf_sizes)
+        self.print_tests_csv(test_kd_buildup, base_filename + '_kd_tree', leaf_sizes)
+
+    # peak memory of building straight from a file, per format; the points are written out first
+    def print_file_tests_csv(
+            self,
+            file_tester: Callable[[str, int], float],
+            filename: str,
+            leaf_sizes: List[int] = (1,),
+            file_formats: List[str] = FILE_FORMATS
+    ):
+        with tempfile.TemporaryDirectory() as directory, open(filename + '_file_memtest.csv', 'w') as file:
+            file.write('n;format;leaf_size;memory\n')
+            for i in range(len(self.n_values)):
+                for file_format in file_formats:
+                    paths = []
+                    for j, points in enumerate(self.test_points[i]):
+                        paths.append(os.path.join(directory, '{}_{}.{}'.format(i, j, file_format)))
+                        xs, ys = array('d', [p[0] for p in points]), array('d', [p[1] for p in points])
+                        write_coordinates(paths[-1], xs, ys, file_format)
+                    for leaf_size in leaf_sizes:
+                        result = [file_tester(path, leaf_size) for path in paths]
+                        file.write('{};{};{};{}\n'.format(
+                            self.n_values[i], file_format, leaf_size, sum(result) / len(result)
+                        ))
+                    for path in paths:
+                        os.remove(path)
+
+    def print_file_tests_both_trees_csv(self, base_filename: str, leaf_sizes: List[int] = (1,)):
+        self.print_file_tests_csv(test_quadtree_from_file, base_filename + '_quadtree', leaf_sizes)
+        self.print_file_tests_csv(test_kd_from_file, base_filename + '_kd_tree', leaf_sizes)
 
 
 class TesterCluster(Tester):
@@ -79,6 +140,24 @@ class TesterCluster(Tester):
         ))
 
 
+class TesterDuplicates(Tester):
+    def __init__(
+            self, n_values: List[int],
+            averaging_iterations: int,
+            scope: Tuple[float, float] = (0, 100),
+            spot_amount: int = 5,
+            jitter: float = 0
+    ):
+        super().__init__(n_values, 0)
+        self.test_points = list(map(
+            lambda n: [
+                gen_point_duplicates(scope=scope, n=n, spot_amount=spot_amount, jitter=jitter)
+                for _ in range(averaging_iterations)
+            ],
+            self.n_values
+        ))
+
+
 if __name__ == "__main__":
     tester = Tester([10000], 50)
-    tester.print_tests_both_trees_csv("dupa")
+    tester.print_tests_both_trees_csv(sys.argv[1] if len(sys.argv) > 1 else "uniform", leaf_sizes=[1, 4, 16, 64])
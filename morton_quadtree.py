@@ -0,0 +1,221 @@
+import struct
+import sys
+from array import array
+from bisect import bisect_left, bisect_right
+from heapq import merge
+from typing import Iterator, List, Optional, Sequence, Tuple, Union
+
+from geometry import Point, Rectangle
+from flat_tree import PointSource, RectangleSource, SearchMode, as_coordinates, as_ids, as_query_boxes
+
+# bits of a grid coordinate per axis, keys interleave both into 2 * _BITS bits
+_BITS = 30
+_CELLS = 1 << _BITS
+# query blocks are refined down to 1 / 2 ** _REFINE of the query's larger side, finer blocks are
+# scanned whole, which keeps a query to a few dozen key ranges
+_REFINE = 3
+
+_FILE_MAGIC = b'MORTONQT'
+_FILE_VERSION = 1
+# magic, format version, byte order, bits per axis, point count, next id, grid bounds
+_FILE_HEADER = struct.Struct('<8sIcIqq4d')
+
+KeyRange = Tuple[int, int, bool]
+
+
+def _spread(v: int) -> int:
+    v = (v | (v << 16)) & 0x0000FFFF0000FFFF
+    v = (v | (v << 8)) & 0x00FF00FF00FF00FF
+    v = (v | (v << 4)) & 0x0F0F0F0F0F0F0F0F
+    v = (v | (v << 2)) & 0x3333333333333333
+    return (v | (v << 1)) & 0x5555555555555555
+
+
+def morton_key(cell_x: int, cell_y: int) -> int:
+    return _spread(cell_x) | (_spread(cell_y) << 1)
+
+
+# A linear quadtree: every point is reduced to the Morton (Z-order) key of its cell in a
+# 2 ** _BITS grid over the bounds given at build time, and the points are kept sorted by key, so
+# every quadtree block is a contiguous run of the arrays. Points outside of the grid are clamped
+# to its edge cells, which only costs precision, as candidates are always checked exactly.
+class MortonQuadtree:
+    def __init__(self, points: PointSource, ids: Optional[Sequence[int]] = None,
+                 bounds: Optional[Tuple[float, float, float, float]] = None):
+        xs, ys = as_coordinates(points)
+        if bounds is None:
+            if len(xs) == 0:
+                raise ValueError('cannot build a quadtree without points or bounds')
+            bounds = min(xs), max(xs), min(ys), max(ys)
+        self.__set_grid(bounds)
+        self.__next_id: int = len(xs) if ids is None else (max(ids) + 1 if len(ids) > 0 else 0)
+        ids = as_ids(ids, len(xs)) if ids is not None else array('q', range(len(xs)))
+        keys = [morton_key(self.__cell_x(x), self.__cell_y(y)) for x, y in zip(xs, ys)]
+        order = sorted(range(len(xs)), key=keys.__getitem__)
+        self.keys: array = array('q', [keys[i] for i in order])
+        self.xs: array = array('d', [xs[i] for i in order])
+        self.ys: array = array('d', [ys[i] for i in order])
+        self.ids: array = array('q', [ids[i] for i in order])
+
+    def __set_grid(self, bounds: Tuple[float, float, float, float]):
+        self.bounds: Tuple[float, float, float, float] = bounds
+        min_x, max_x, min_y, max_y = bounds
+        self.__scale_x: float = _CELLS / (max_x - min_x) if max_x > min_x else 0.0
+        self.__scale_y: float = _CELLS / (max_y - min_y) if max_y > min_y else 0.0
+
+    def __cell_x(self, x: float) -> int:
+        return min(max(int((x - self.bounds[0]) * self.__scale_x), 0), _CELLS - 1)
+
+    def __cell_y(self, y: float) -> int:
+        return min(max(int((y - self.bounds[2]) * self.__scale_y), 0), _CELLS - 1)
+
+    def __len__(self) -> int:
+        return len(self.keys)
+
+    @property
+    def points(self) -> List[Point]:
+        return list(zip(self.xs, self.ys))
+
+    def insert(self, point: Point, point_id: Optional[int] = None) -> int:
+        x, y = point
+        if point_id is None:
+            point_id = self.__next_id
+        self.__next_id = max(self.__next_id, point_id + 1)
+        key = morton_key(self.__cell_x(x), self.__cell_y(y))
+        position = bisect_right(self.keys, key)
+        self.keys.insert(position, key)
+        self.xs.insert(position, x)
+        self.ys.insert(position, y)
+        self.ids.insert(position, point_id)
+        return point_id
+
+    def remove(self, point: Point) -> bool:
+        x, y = point
+        key = morton_key(self.__cell_x(x), self.__cell_y(y))
+        for position in range(bisect_left(self.keys, key), bisect_right(self.keys, key)):
+            if self.xs[position] == x and self.ys[position] == y:
+                for column in (self.keys, self.xs, self.ys, self.ids):
+                    del column[position]
+                return True
+        return False
+
+    # Trees over the same grid are merged in one linear pass over both key orders; otherwise the
+    # points of `other` are keyed into this tree's grid first. Ids of both trees are kept as they are.
+    def merge(self, other: 'MortonQuadtree') -> 'MortonQuadtree':
+        result = MortonQuadtree([], bounds=self.bounds)
+        if other.bounds == self.bounds:
+            other_rows = zip(other.keys, other.xs, other.ys, other.ids)
+        else:
+            other_keys = [morton_key(self.__cell_x(x), self.__cell_y(y)) for x, y in zip(other.xs, other.ys)]
+            other_rows = sorted(zip(other_keys, other.xs, other.ys, other.ids), key=lambda row: row[0])
+        rows = merge(zip(self.keys, self.xs, self.ys, self.ids), other_rows, key=lambda row: row[0])
+        for key, x, y, point_id in rows:
+            result.keys.append(key)
+            result.xs.append(x)
+            result.ys.append(y)
+            result.ids.append(point_id)
+        result.__next_id = max(self.__next_id, other.__next_id)
+        return result
+
+    def save(self, path: str):
+        with open(path, 'wb') as file:
+            file.write(_FILE_HEADER.pack(
+                _FILE_MAGIC, _FILE_VERSION, sys.byteorder[0].encode(), _BITS, len(self), self.__next_id, *self.bounds
+            ))
+            for column in (self.keys, self.xs, self.ys, self.ids):
+                column.tofile(file)
+
+    @staticmethod
+    def load(path: str) -> 'MortonQuadtree':
+        with open(path, 'rb') as file:
+            magic, version, byte_order, bits, count, next_id, *bounds = _FILE_HEADER.unpack(
+                file.read(_FILE_HEADER.size)
+            )
+            if magic != _FILE_MAGIC:
+                raise ValueError('{} is not a saved Morton quadtree'.format(path))
+            if version != _FILE_VERSION or bits != _BITS:
+                raise ValueError('unsupported Morton quadtree file version {} in {}'.format(version, path))
+            if byte_order != sys.byteorder[0].encode():
+                raise ValueError('{} was saved on a machine with a different byte order'.format(path))
+            tree = MortonQuadtree([], bounds=tuple(bounds))
+            for column in (tree.keys, tree.xs, tree.ys, tree.ids):
+                column.fromfile(file, count)
+        tree.__next_id = next_id
+        return tree
+
+    # Splits the query's cell box into aligned quadtree blocks, each of them a contiguous key
+    # range. A range is exact when its block lies strictly inside of the cell box: the cells on
+    # the edge of the box may hold points outside of the query and have to be checked one by one.
+    def key_ranges(self, rect: Rectangle) -> List[KeyRange]:
+        low_x, high_x = self.__cell_x(rect.min_x), self.__cell_x(rect.max_x)
+        low_y, high_y = self.__cell_y(rect.min_y), self.__cell_y(rect.max_y)
+        min_level = max(0, max(high_x - low_x, high_y - low_y).bit_length() - _REFINE)
+        ranges: List[KeyRange] = []
+        stack = [(0, 0, _BITS)]
+        while len(stack) > 0:
+            x, y, level = stack.pop()
+            size = 1 << level
+            if x > high_x or x + size <= low_x or y > high_y or y + size <= low_y:
+                continue
+            covered = low_x <= x and x + size - 1 <= high_x and low_y <= y and y + size - 1 <= high_y
+            if covered or level <= min_level:
+                first = morton_key(x, y)
+                exact = low_x < x and x + size - 1 < high_x and low_y < y and y + size - 1 < high_y
+                if len(ranges) > 0 and ranges[-1][1] == first and ranges[-1][2] == exact:
+                    ranges[-1] = ranges[-1][0], first + (1 << 2 * level), exact
+                else:
+                    ranges.append((first, first + (1 << 2 * level), exact))
+                continue
+            half = size >> 1
+            # pushed in reverse Z order, so that ranges come out sorted and adjacent ones can merge
+            stack.extend(((x + half, y + half, level - 1), (x, y + half, level - 1),
+                          (x + half, y, level - 1), (x, y, level - 1)))
+        return ranges
+
+    def __positions(self, rect: Rectangle) -> Iterator[int]:
+        keys, xs, ys = self.keys, self.xs, self.ys
+        for first, end, exact in self.key_ranges(rect):
+            start, stop = bisect_left(keys, first), bisect_left(keys, end)
+            if exact:
+                yield from range(start, stop)
+            else:
+                yield from (
+                    i for i in range(start, stop)
+                    if rect.min_x < xs[i] <= rect.max_x and rect.min_y < ys[i] <= rect.max_y
+                )
+
+    def __count(self, rect: Rectangle) -> int:
+        keys, xs, ys = self.keys, self.xs, self.ys
+        count = 0
+        for first, end, exact in self.key_ranges(rect):
+            start, stop = bisect_left(keys, first), bisect_left(keys, end)
+            if exact:
+                count += stop - start
+            else:
+                count += sum(
+                    1 for i in range(start, stop)
+                    if rect.min_x < xs[i] <= rect.max_x and rect.min_y < ys[i] <= rect.max_y
+                )
+        return count
+
+    def find(self, rect: Rectangle, mode: SearchMode = SearchMode.LIST) \
+            -> Union[List[Point], Iterator[Point], int, bool, array]:
+        xs, ys = self.xs, self.ys
+        if mode is SearchMode.ITER:
+            return ((xs[i], ys[i]) for i in self.__positions(rect))
+        if mode is SearchMode.COUNT:
+            return self.__count(rect)
+        if mode is SearchMode.EXISTS:
+            return any(True for _ in self.__positions(rect))
+        positions = array('q', self.__positions(rect))
+        if mode is SearchMode.INDICES:
+            return array('q', [self.ids[i] for i in positions])
+        return [(xs[i], ys[i]) for i in positions]
+
+    def find_many(self, rects: RectangleSource) -> Tuple[array, array]:
+        indices = array('q')
+        offsets = array('q', [0])
+        for box in as_query_boxes(rects):
+            indices.extend(self.find(Rectangle(*box), SearchMode.INDICES))
+            offsets.append(len(indices))
+        return indices, offsets
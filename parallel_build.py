@@ -0,0 +1,99 @@
+from array import array
+from multiprocessing import Pool
+from multiprocessing.shared_memory import SharedMemory
+from typing import Callable, Dict, List, Optional, Tuple, Type, Union
+
+from flat_tree import FlatTree
+
+Builder = Callable[[FlatTree, int, Optional[int]], None]
+_Task = Tuple[Type[FlatTree], Builder, int, List[str], int, List[Union[int, float]]]
+
+
+def _shared_copy(values: array) -> SharedMemory:
+    shared = SharedMemory(create=True, size=max(1, len(values) * values.itemsize))
+    shared.buf[:len(values) * values.itemsize] = values.tobytes()
+    return shared
+
+
+def _build_fragment(task: _Task) -> List[array]:
+    tree_class, build, leaf_size, names, count, row = task
+    shared = [SharedMemory(name=name) for name in names]
+    views = [
+        shared[0].buf[:count * 8].cast('d'),
+        shared[1].buf[:count * 8].cast('d'),
+        shared[2].buf[:count * 8].cast('q')
+    ]
+    try:
+        fragment = tree_class(views[0], views[1], leaf_size, perm=views[2])
+        fragment.add_node(0, 0, 0.0, 0.0, 0.0, 0.0)
+        for column, value in zip(fragment.columns(), row):
+            column[0] = value
+        build(fragment, 0, None)
+        columns = fragment.columns()
+        del fragment
+        return columns
+    finally:
+        for view in views:
+            view.release()
+        for segment in shared:
+            segment.close()
+
+
+# The nodes of the top `levels` levels are split in this process, the subtrees below them are built
+# by the pool over coordinates and a permutation held in shared memory. Every fragment comes back
+# numbered from its own root, and the parts are stitched in the order a serial build allocates
+# nodes in, so the resulting arrays are identical to those of a serial build.
+def build_parallel(tree: FlatTree, build: Builder, workers: int, levels: int):
+    top = type(tree)(tree.xs, tree.ys, tree.leaf_size, perm=tree.perm)
+    top.add_node(tree.start[0], tree.end[0], tree.min_x[0], tree.max_x[0], tree.min_y[0], tree.max_y[0])
+    build(top, 0, levels)
+
+    pending = [
+        node for node in range(top.node_count)
+        if top.is_leaf(node) and top.end[node] - top.start[node] > top.leaf_size
+    ]
+    fragments: Dict[int, List[array]] = {}
+    if len(pending) > 0:
+        count = len(tree.xs)
+        shared = [_shared_copy(tree.xs), _shared_copy(tree.ys), _shared_copy(tree.perm)]
+        try:
+            names = [segment.name for segment in shared]
+            tasks = [
+                (type(tree), build, tree.leaf_size, names, count, [column[node] for column in top.columns()])
+                for node in pending
+            ]
+            with Pool(workers) as pool:
+                for node, columns in zip(pending, pool.imap(_build_fragment, tasks)):
+                    fragments[node] = columns
+            perm = array('q')
+            perm.frombytes(shared[2].buf[:count * 8])
+            tree.perm[:] = perm
+        finally:
+            for segment in shared:
+                segment.close()
+                segment.unlink()
+
+    tree.clear_nodes()
+    for column, top_column in zip(tree.columns(), top.columns()):
+        column.append(top_column[0])
+    _stitch(tree, top, fragments, 0, 0)
+
+
+def _stitch(tree: FlatTree, top: FlatTree, fragments: Dict[int, List[array]], top_node: int, node: int):
+    stack = [(top_node, node)]
+    while len(stack) > 0:
+        top_node, node = stack.pop()
+        if top.is_leaf(top_node):
+            fragment = fragments.get(top_node)
+            if fragment is not None:
+                tree.append_subtree(node, fragment)
+            continue
+
+        first = tree.node_count
+        for child in top.children(top_node):
+            for column, top_column in zip(tree.columns(), top.columns()):
+                column.append(top_column[child])
+        tree.set_children(node, first, top.child_count[top_node])
+        stack.extend(
+            (child, first + offset) for offset, child in reversed(list(enumerate(top.children(top_node))))
+        )
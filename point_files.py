@@ -0,0 +1,137 @@
+import ast
+import csv
+import os
+import struct
+import sys
+from array import array
+from typing import Iterator, Optional, Tuple
+
+# rows per chunk read from a file; coordinates go straight into the output arrays, so peak
+# memory is the arrays themselves plus a single chunk
+CHUNK_ROWS = 1 << 16
+
+Chunk = Tuple[array, array]
+
+_NPY_MAGIC = b'\x93NUMPY'
+_FORMATS = {'.csv': 'csv', '.txt': 'csv', '.npy': 'npy', '.bin': 'raw', '.f64': 'raw', '.raw': 'raw'}
+
+
+def _format_of(path: str, file_format: Optional[str]) -> str:
+    if file_format is not None:
+        return file_format
+    extension = os.path.splitext(path)[1].lower()
+    if extension not in _FORMATS:
+        raise ValueError('cannot guess the format of {}, pass one of csv, raw, npy'.format(path))
+    return _FORMATS[extension]
+
+
+def _interleaved_chunks(file, typecode: str, swap: bool, count: Optional[int] = None) -> Iterator[Chunk]:
+    item_size = array(typecode).itemsize
+    while count is None or count > 0:
+        rows = CHUNK_ROWS if count is None else min(CHUNK_ROWS, count)
+        data = file.read(rows * 2 * item_size)
+        if len(data) == 0:
+            break
+        if len(data) % (2 * item_size) != 0:
+            raise ValueError('file ends in the middle of a coordinate pair')
+        chunk = array(typecode)
+        chunk.frombytes(data)
+        if swap:
+            chunk.byteswap()
+        yield array('d', chunk[0::2]), array('d', chunk[1::2])
+        if count is not None:
+            count -= len(chunk) // 2
+    if count is not None and count > 0:
+        raise ValueError('file holds {} pairs less than its header declares'.format(count))
+
+
+def _csv_chunks(path: str, delimiter: str, x_column: int, y_column: int) -> Iterator[Chunk]:
+    xs, ys = array('d'), array('d')
+    with open(path, newline='') as file:
+        reader = csv.reader(file, delimiter=delimiter)
+        for row_number, row in enumerate(reader):
+            if len(row) == 0:
+                continue
+            try:
+                x, y = float(row[x_column]), float(row[y_column])
+            except ValueError:
+                if row_number == 0:
+                    continue
+                raise ValueError('{}:{}: not a coordinate row: {}'.format(path, row_number + 1, row))
+            xs.append(x)
+            ys.append(y)
+            if len(xs) == CHUNK_ROWS:
+                yield xs, ys
+                xs, ys = array('d'), array('d')
+    if len(xs) > 0:
+        yield xs, ys
+
+
+def _npy_chunks(path: str) -> Iterator[Chunk]:
+    with open(path, 'rb') as file:
+        if file.read(6) != _NPY_MAGIC:
+            raise ValueError('{} is not a .npy file'.format(path))
+        major = file.read(2)[0]
+        header_length = struct.unpack('<H' if major == 1 else '<I', file.read(2 if major == 1 else 4))[0]
+        header = ast.literal_eval(file.read(header_length).decode('latin1'))
+        shape, descr = tuple(header['shape']), header['descr']
+        if header['fortran_order'] or len(shape) != 2 or shape[1] != 2:
+            raise ValueError('{} has to hold a C-ordered (n, 2) array, got shape {}'.format(path, shape))
+        if descr[1:] not in ('f8', 'f4'):
+            raise ValueError('{} has to hold float64 or float32 coordinates, got {}'.format(path, descr))
+        swap = descr[0] in '<>' and descr[0] != ('<' if sys.byteorder == 'little' else '>')
+        yield from _interleaved_chunks(file, 'd' if descr[1:] == 'f8' else 'f', swap, shape[0])
+
+
+# Formats: 'csv' (one point per row, a non-numeric first row is taken for a header), 'raw'
+# (native float64 x, y pairs, as written by array.tofile) and 'npy' (an (n, 2) float array).
+# Yields the points as (xs, ys) chunks of at most CHUNK_ROWS coordinates each.
+def iter_coordinate_chunks(path: str, file_format: Optional[str] = None, delimiter: str = ',',
+                           x_column: int = 0, y_column: int = 1) -> Iterator[Chunk]:
+    file_format = _format_of(path, file_format)
+    if file_format == 'csv':
+        yield from _csv_chunks(path, delimiter, x_column, y_column)
+    elif file_format == 'raw':
+        with open(path, 'rb') as file:
+            yield from _interleaved_chunks(file, 'd', False)
+    elif file_format == 'npy':
+        yield from _npy_chunks(path)
+    else:
+        raise ValueError('unknown point file format {}'.format(file_format))
+
+
+def read_coordinates(path: str, file_format: Optional[str] = None, delimiter: str = ',',
+                     x_column: int = 0, y_column: int = 1) -> Tuple[array, array]:
+    xs, ys = array('d'), array('d')
+    for chunk_xs, chunk_ys in iter_coordinate_chunks(path, file_format, delimiter, x_column, y_column):
+        xs.extend(chunk_xs)
+        ys.extend(chunk_ys)
+    return xs, ys
+
+
+def write_pairs(file, xs: array, ys: array):
+    for start in range(0, len(xs), CHUNK_ROWS):
+        chunk = array('d', [0.0]) * (2 * len(xs[start:start + CHUNK_ROWS]))
+        chunk[0::2] = xs[start:start + CHUNK_ROWS]
+        chunk[1::2] = ys[start:start + CHUNK_ROWS]
+        chunk.tofile(file)
+
+
+def write_coordinates(path: str, xs: array, ys: array, file_format: Optional[str] = None):
+    file_format = _format_of(path, file_format)
+    if file_format == 'csv':
+        with open(path, 'w', newline='') as file:
+            writer = csv.writer(file)
+            writer.writerow(('x', 'y'))
+            writer.writerows(zip(xs, ys))
+        return
+    if file_format not in ('raw', 'npy'):
+        raise ValueError('unknown point file format {}'.format(file_format))
+    with open(path, 'wb') as file:
+        if file_format == 'npy':
+            header = "{{'descr': '{}f8', 'fortran_order': False, 'shape': ({}, 2), }}".format(
+                '<' if sys.byteorder == 'little' else '>', len(xs)
+            )
+            header += ' ' * (-(len(_NPY_MAGIC) + 4 + len(header) + 1) % 64) + '\n'
+            file.write(_NPY_MAGIC + bytes([1, 0]) + struct.pack('<H', len(header)) + header.encode('latin1'))
+        write_pairs(file, xs, ys)
@@ -1,9 +1,18 @@
+from array import array
 from enum import IntEnum
-from typing import List
-from draw_tool import *
-import copy
+from functools import partial
+from math import inf
+from typing import List, Optional, Sequence, Tuple
 
-from geometry import Point, Rectangle
+from geometry import Rectangle
+from flat_tree import FlatTree, PointSource, SearchMode, as_coordinates
+from search_tree import SearchTree
+from tracing import Tracer
+
+
+_FILE_KIND = 'quadtree'
+# deeper nodes are never split, so clustered points cost at most this many nodes each
+_MAX_DEPTH = 32
 
 
 class Quadrant(IntEnum):
@@ -13,116 +22,207 @@ class Quadrant(IntEnum):
     SE = 3
 
 
-class _Node:
-
-    def __init__(self, n, s, w, e, quadrant):
-        self.boundary = Rectangle(w, e, s, n)
-        self.pos = None
-        self.max_y = n
-        self.min_y = s
-        self.min_x = w
-        self.max_x = e
-        self.mid_y = (self.min_y + self.max_y) / 2
-        self.mid_x = (self.min_x + self.max_x) / 2
-        self.quadrant = quadrant
-        self.children = None
-
-    def add_child(self, node):
-        if self.children is None:
-            self.children = [None for _ in range(4)]
-        self.children[node.quadrant] = node
-
-
-class Quadtree:
-
-    def __init__(self, points: List[Point]):
-        n = max(points, key=lambda p: p[1])[1]
-        s = min(points, key=lambda p: p[1])[1]
-        w = min(points, key=lambda p: p[0])[0]
-        e = max(points, key=lambda p: p[0])[0]
-        self.points = points
-        self.root = _Node(n, s, w, e, None)
-        self.__create_quadtree(self.root, points)
-
-    def __create_quadtree(self, node: _Node, points: List[Point]):
-        if len(points) == 1:
-            node.pos = points[0]
-        if len(points) <= 1:
-            return
-        ne = _Node(node.max_y, node.mid_y, node.mid_x, node.max_x, Quadrant.NE)
-        nw = _Node(node.max_y, node.mid_y, node.min_x, node.mid_x, Quadrant.NW)
-        sw = _Node(node.mid_y, node.min_y, node.min_x, node.mid_x, Quadrant.SW)
-        se = _Node(node.mid_y, node.min_y, node.mid_x, node.max_x, Quadrant.SE)
-
-        points_ne = [p for p in points if p[0] > node.mid_x and p[1] >= node.mid_y]
-        points_nw = [p for p in points if p[0] <= node.mid_x and p[1] > node.mid_y]
-        points_sw = [p for p in points if p[0] < node.mid_x and p[1] <= node.mid_y]
-        points_se = [p for p in points if p[0] >= node.mid_x and p[1] < node.mid_y]
-
-        node.add_child(ne)
-        self.__create_quadtree(ne, points_ne)
-        node.add_child(nw)
-        self.__create_quadtree(nw, points_nw)
-        node.add_child(sw)
-        self.__create_quadtree(sw, points_sw)
-        node.add_child(se)
-        self.__create_quadtree(se, points_se)
-
-    def __find(self, node: _Node, rect: Rectangle, res: List[Point], view):
-        if rect.min_x > node.max_x or rect.max_x < node.min_x or rect.min_y > node.max_y or rect.max_y < node.min_y:
-            return
-        if view is not None:
-            view.visited_quadrants.extend(node.boundary.get_lines())
-        if node.children is None:
-            if node.pos is not None and rect.point_inside(node.pos):
-                res.append(node.pos)
-                if view is not None:
-                    view.points_inside.append(node.pos)
-                    view.gen_scene()
+# Quadrants are half-open the way Rectangle.point_inside is: a point on a midline belongs to
+# the quadrant on its lower side, i.e. east means mid_x < x and north means mid_y < y.
+def _quadrant(x: float, y: float, mid_x: float, mid_y: float) -> Quadrant:
+    if x > mid_x:
+        return Quadrant.NE if y > mid_y else Quadrant.SE
+    return Quadrant.NW if y > mid_y else Quadrant.SW
+
+
+def _quadrant_boundary(quadrant: Quadrant, min_x: float, max_x: float, min_y: float, max_y: float) \
+        -> Tuple[float, float, float, float]:
+    mid_x = (min_x + max_x) / 2
+    mid_y = (min_y + max_y) / 2
+    if quadrant is Quadrant.NE:
+        return mid_x, max_x, mid_y, max_y
+    elif quadrant is Quadrant.NW:
+        return min_x, mid_x, mid_y, max_y
+    elif quadrant is Quadrant.SW:
+        return min_x, mid_x, min_y, mid_y
+    else:
+        return mid_x, max_x, min_y, mid_y
+
+
+# Only non-empty quadrants get a node, the children of a node are stored next to each other in
+# Quadrant order. The builder splits nodes by their boxes, which hold the quadrant boundaries
+# until the finished tree is tightened to its points; after that only the root's boundary is
+# kept, in `cell`, and every other one follows from it and the quadrants on the way down.
+class _QuadArrays(FlatTree):
+    COLUMNS = FlatTree.COLUMNS + ('quadrant', 'depth')
+    EXTRA = ('cell',)
+
+    def __init__(self, xs: array, ys: array, leaf_size: int = 1, perm: Optional[array] = None):
+        super().__init__(xs, ys, leaf_size, perm)
+        self.quadrant: array = array('b')
+        self.depth: array = array('b')
+        self.cell: array = array('d', [0.0, 0.0, 0.0, 0.0])
+
+    def add_node(self, start: int, end: int, min_x: float, max_x: float, min_y: float, max_y: float) -> int:
+        self.quadrant.append(0)
+        self.depth.append(0)
+        return super().add_node(start, end, min_x, max_x, min_y, max_y)
+
+    def child_in(self, node: int, quadrant: Quadrant) -> int:
+        for child in self.children(node):
+            if self.quadrant[child] == quadrant:
+                return child
+        return -1
+
+    # The children block of a node cannot grow in place, so it is copied to the end of the arrays
+    # together with the new, empty child, whose box is left inverted.
+    def add_child(self, node: int, quadrant: Quadrant) -> int:
+        old_children = self.children(node)
+        first = self.node_count
+        added = -1
+        for q in Quadrant:
+            child = self.child_in(node, q)
+            if child >= 0:
+                self.copy_node(child)
+            elif q is quadrant:
+                added = self.add_node(len(self.perm), len(self.perm), inf, -inf, inf, -inf)
+                self.quadrant[added] = q
+                self.depth[added] = self.depth[node] + 1
+        self.set_children(node, first, len(old_children) + 1)
+        self.dead_nodes += len(old_children)
+        return added
+
+
+# A node deeper than max_depth or holding copies of a single point stays a leaf however many
+# points it holds.
+def _create_quadtree(tree: _QuadArrays, node: int, levels: Optional[int] = None, max_depth: int = _MAX_DEPTH):
+    xs, ys = tree.xs, tree.ys
+    stack = [(node, levels)]
+    while len(stack) > 0:
+        node, levels = stack.pop()
+        start, end = tree.start[node], tree.end[node]
+        if end - start <= tree.leaf_size or levels == 0 or tree.depth[node] >= max_depth:
+            continue
+        boundary = tree.min_x[node], tree.max_x[node], tree.min_y[node], tree.max_y[node]
+        mid_x = (boundary[0] + boundary[1]) / 2
+        mid_y = (boundary[2] + boundary[3]) / 2
+
+        quadrants = [array('q') for _ in Quadrant]
+        for i in tree.perm[start:end]:
+            quadrants[_quadrant(xs[i], ys[i], mid_x, mid_y)].append(i)
+        if max(map(len, quadrants)) == end - start:
+            first = tree.perm[start]
+            if all(xs[i] == xs[first] and ys[i] == ys[first] for i in tree.perm[start:end]):
+                continue
+        tree.perm[start:end] = quadrants[Quadrant.NE] + quadrants[Quadrant.NW] + \
+            quadrants[Quadrant.SW] + quadrants[Quadrant.SE]
+
+        first = tree.node_count
+        for quadrant in Quadrant:
+            points = quadrants[quadrant]
+            if len(points) == 0:
+                continue
+            child = tree.add_node(start, start + len(points), *_quadrant_boundary(quadrant, *boundary))
+            tree.quadrant[child] = quadrant
+            tree.depth[child] = tree.depth[node] + 1
+            start += len(points)
+        tree.set_children(node, first, tree.node_count - first)
+
+        levels = levels - 1 if levels is not None else None
+        stack.extend((child, levels) for child in reversed(tree.children(node)))
+
+
+class Quadtree(SearchTree):
+    ARRAYS = _QuadArrays
+    FILE_KIND = _FILE_KIND
+    NAME = 'quadtree'
+
+    def __init__(self, points: PointSource, leaf_size: int = 1, workers: int = 1,
+                 ids: Optional[Sequence[int]] = None, max_depth: int = _MAX_DEPTH,
+                 values: Optional[Sequence[float]] = None):
+        self.build(*as_coordinates(points), leaf_size, workers, ids, max_depth, values)
+
+    def build(self, xs: array, ys: array, leaf_size: int = 1, workers: int = 1, ids: Optional[Sequence[int]] = None,
+              max_depth: int = _MAX_DEPTH, values: Optional[Sequence[float]] = None):
+        if not 0 <= max_depth <= 127:
+            raise ValueError('max depth has to be between 0 and 127, got {}'.format(max_depth))
+        self.__max_depth: int = max_depth
+
+        def split(tree: _QuadArrays):
+            tree.cell = array('d', [tree.min_x[0], tree.max_x[0], tree.min_y[0], tree.max_y[0]])
+            if workers > 1:
+                from parallel_build import build_parallel
+
+                build = partial(_create_quadtree, max_depth=max_depth)
+                build_parallel(tree, build, workers, levels=((4 * workers - 1).bit_length() + 1) // 2)
+            else:
+                _create_quadtree(tree, 0, max_depth=max_depth)
+
+        self.build_tree(xs, ys, leaf_size, ids, values, split)
+
+    def settings(self) -> Tuple[int, ...]:
+        return self.__max_depth,
+
+    def load_settings(self, settings: Tuple[int, ...]):
+        self.__max_depth = settings[0]
+
+    def insert_index(self, index: int, value: Optional[float]):
+        tree = self.tree
+        x, y = tree.xs[index], tree.ys[index]
+        cell = tuple(tree.cell)
+        if len(tree) == 0 or not (cell[0] <= x <= cell[1] and cell[2] <= y <= cell[3]):
+            indices = tree.node_indices(0)
+            indices.append(index)
+            self.__rebuild(indices, grow=True)
             return
-        if view is not None:
-            view.gen_scene()
-        for ch in node.children:
-            self.__find(ch, rect, res, view)
 
-    def find(self, rect: Rectangle, visualize=False):
-        res = []
+        node = 0
+        path = [node]
+        tree.expand(node, x, y, value)
+        while not tree.is_leaf(node):
+            quadrant = _quadrant(x, y, (cell[0] + cell[1]) / 2, (cell[2] + cell[3]) / 2)
+            cell = _quadrant_boundary(quadrant, *cell)
+            child = tree.child_in(node, quadrant)
+            node = child if child >= 0 else tree.add_child(node, quadrant)
+            tree.expand(node, x, y, value)
+            path.append(node)
+        tree.append_to_leaf(path, index)
+        if not tree.holds_copies(node):
+            tree.min_x[node], tree.max_x[node], tree.min_y[node], tree.max_y[node] = cell
+            _create_quadtree(tree, node, max_depth=self.__max_depth)
+            tree.tighten(node)
+        if tree.needs_compaction():
+            self.__rebuild(tree.node_indices(0))
+
+    def after_remove(self, path: List[int], index: int):
+        tree = self.tree
+        tree.tighten_path(path, index)
+        for node in path:
+            if tree.size[node] <= tree.leaf_size:
+                tree.collapse(node)
+                break
+        if tree.needs_compaction():
+            self.__rebuild(tree.node_indices(0))
+
+    # A point outside of the root boundary forces a rebuild, so the new boundary gets a margin
+    # of half its size on every side to keep a stream of such points from rebuilding every time.
+    def __rebuild(self, indices: array, grow: bool = False):
+        tree = self.tree
+        tree.reset(indices)
+        if grow:
+            margin_x = (tree.max_x[0] - tree.min_x[0]) / 2
+            margin_y = (tree.max_y[0] - tree.min_y[0]) / 2
+            tree.min_x[0] -= margin_x
+            tree.max_x[0] += margin_x
+            tree.min_y[0] -= margin_y
+            tree.max_y[0] += margin_y
+        tree.cell = array('d', [tree.min_x[0], tree.max_x[0], tree.min_y[0], tree.max_y[0]])
+        _create_quadtree(tree, 0, max_depth=self.__max_depth)
+        tree.tighten(0)
+
+    def find(self, rect: Rectangle, visualize=False, mode: SearchMode = SearchMode.LIST,
+             tracer: Optional[Tracer] = None):
         if visualize:
-            view = View(self.points, rect, self.root)
-            self.__find(self.root, rect, res, view)
-            return view.get_plot()
-        else:
-            self.__find(self.root, rect, res, None)
-            return res
-
-
-class View:
-
-    def __init__(self, points: List[Point], rect: Rectangle, root: _Node):
-        self.scenes = []
-        self.quadrants = []
-        self.visited_quadrants = []
-        self.points_inside = []
-        self.points = PointsCollection(points)
-        self.rect = LinesCollection(lines=rect.get_lines(), color='black')
-        self.__gen_quadrants(root)
-        self.quadrants = LinesCollection(self.quadrants)
-        self.gen_scene()
-
-    def __gen_quadrants(self, node: _Node):
-        self.quadrants.extend(node.boundary.get_lines())
-        if node.children is not None:
-            for ch in node.children:
-                if ch is not None:
-                    self.__gen_quadrants(ch)
-
-    def gen_scene(self):
-        self.scenes.append(Scene(points=[self.points, PointsCollection(copy.deepcopy(self.points_inside), color='red')],
-                                 lines=[self.quadrants, self.rect,
-                                        LinesCollection(self.visited_quadrants[:-4],
-                                                        color='green'),
-                                        LinesCollection(self.visited_quadrants[-4:],
-                                                        color='red')]))
-
-    def get_plot(self) -> Plot:
-        return Plot(scenes=self.scenes)
+            from draw_tool import Plot
+
+            return Plot(scenes=self.visualized_search(rect, mode, tracer)[1])
+        return self.range_search(rect, mode, tracer)
+
+    find_aggregate = SearchTree.aggregate
+    find_many = SearchTree.range_search_many
+
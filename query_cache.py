@@ -0,0 +1,67 @@
+from array import array
+from collections import OrderedDict
+from typing import Optional, Tuple
+from flat_tree import FlatTree
+from geometry import Rectangle
+from tracing import Tracer
+
+# rough size of an entry apart from its indices: the key tuple, the rectangle and the dict slot
+_ENTRY_OVERHEAD = 400
+
+
+# Least recently used range search results of one tree, as point indices, kept within max_bytes.
+# A query equal to a cached rectangle is answered with its result, a query nested in one (by
+# Rectangle.contains) by filtering the smallest such result, anything else by searching the tree.
+# Indices are only valid for the tree they came from, so its owner clears the cache on every change.
+# Callers get a copy of the cached indices, which they are free to modify.
+class QueryCache:
+    def __init__(self, max_bytes: int):
+        self.max_bytes: int = max_bytes
+        self.bytes: int = 0
+        self.hits: int = 0
+        self.nested_hits: int = 0
+        self.misses: int = 0
+        self.__entries: 'OrderedDict[Tuple[float, float, float, float], Tuple[Rectangle, array]]' = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self.__entries)
+
+    def clear(self):
+        self.__entries.clear()
+        self.bytes = 0
+
+    # the tracer only sees the tree searches of misses
+    def search(self, tree: FlatTree, rect: Rectangle, tracer: Optional[Tracer] = None) -> array:
+        key = rect.to_tuple()
+        entry = self.__entries.get(key)
+        if entry is not None:
+            self.hits += 1
+            self.__entries.move_to_end(key)
+            return array('q', entry[1])
+
+        container: Optional[Tuple[Tuple[float, float, float, float], array]] = None
+        for cached_key, (cached_rect, indices) in self.__entries.items():
+            if cached_rect.contains(rect) and (container is None or len(indices) < len(container[1])):
+                container = cached_key, indices
+        if container is not None:
+            self.nested_hits += 1
+            self.__entries.move_to_end(container[0])
+            xs, ys = tree.xs, tree.ys
+            result = array('q', [
+                i for i in container[1] if rect.min_x < xs[i] <= rect.max_x and rect.min_y < ys[i] <= rect.max_y
+            ])
+        else:
+            self.misses += 1
+            result = tree.search_range(rect, tracer)
+        self.__store(key, rect, result)
+        return array('q', result)
+
+    def __store(self, key: Tuple[float, float, float, float], rect: Rectangle, result: array):
+        cost = len(result) * result.itemsize + _ENTRY_OVERHEAD
+        if cost > self.max_bytes:
+            return
+        self.__entries[key] = rect, result
+        self.bytes += cost
+        while self.bytes > self.max_bytes:
+            _, (_, evicted) = self.__entries.popitem(last=False)
+            self.bytes -= len(evicted) * evicted.itemsize + _ENTRY_OVERHEAD
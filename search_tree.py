@@ -0,0 +1,181 @@
+from array import array
+from typing import Callable, Iterator, List, Optional, Sequence, Tuple, Type, Union, TYPE_CHECKING
+from geometry import Point, Line, Rectangle
+from flat_tree import Aggregate, FlatTree, RectangleSource, SearchMode, TreeStats, as_ids, as_values
+from point_files import read_coordinates
+from query_cache import QueryCache
+from tracing import StatsCollector, TraceRecorder, Tracer, chain, combine
+
+if TYPE_CHECKING:
+    from draw_tool import Scene
+    from visualization import SearchScenes
+
+
+# What KDTree and Quadtree share on top of their node arrays `tree`: building and loading them,
+# updates, the query cache and statistics and range searches in every mode. A subclass names its
+# arrays and file kind and implements the methods below that raise NotImplementedError.
+class SearchTree:
+    ARRAYS: Type[FlatTree] = FlatTree
+    FILE_KIND: str = ''
+    # what error messages call the structure
+    NAME: str = ''
+
+    # builds over the given coordinate arrays without copying them, the tree appends inserted points to them;
+    # the other arguments are the constructor's after the points
+    @classmethod
+    def from_coordinates(cls, xs: array, ys: array, *args, **kwargs):
+        structure = cls.__new__(cls)
+        structure.build(xs, ys, *args, **kwargs)
+        return structure
+
+    # file_format, delimiter, x_column and y_column are passed to read_coordinates
+    @classmethod
+    def from_file(cls, path: str, *args, file_format: Optional[str] = None, delimiter: str = ',',
+                  x_column: int = 0, y_column: int = 1, **kwargs):
+        return cls.from_coordinates(*read_coordinates(path, file_format, delimiter, x_column, y_column),
+                                    *args, **kwargs)
+
+    # the constructor's work once the points are coordinate arrays, it ends with build_tree
+    def build(self, xs: array, ys: array, *args, **kwargs):
+        raise NotImplementedError
+
+    # Builds the node arrays over the coordinates: a root node holding all of them, which `split`
+    # divides, then tight boxes and the value summaries.
+    def build_tree(self, xs: array, ys: array, leaf_size: int, ids: Optional[Sequence[int]],
+                   values: Optional[Sequence[float]], split: Callable[[FlatTree], None]):
+        if len(xs) == 0:
+            raise ValueError('cannot build a {} without points'.format(self.NAME))
+        tree = self.ARRAYS(xs, ys, leaf_size)
+        if ids is not None:
+            tree.ids = as_ids(ids, len(xs))
+        tree.add_node(0, len(xs), min(xs), max(xs), min(ys), max(ys))
+        split(tree)
+        tree.tighten(0)
+        if values is not None:
+            tree.set_values(as_values(values, len(xs)))
+        self.__attach(tree)
+
+    def __attach(self, tree: FlatTree):
+        self.tree = tree
+        # set to a QueryCache to serve repeated and nested LIST searches from earlier results
+        self.cache: Optional[QueryCache] = None
+        # set to a StatsCollector to count the nodes visited by LIST and INDICES searches
+        self.query_stats: Optional[StatsCollector] = None
+        self.__visual_lines: Optional[Tuple[List[Line], List[Line]]] = None
+
+    # build settings saved along with the tree, restored by load_settings
+    def settings(self) -> Tuple[int, ...]:
+        raise NotImplementedError
+
+    def load_settings(self, settings: Tuple[int, ...]):
+        raise NotImplementedError
+
+    def save(self, path: str):
+        self.tree.save(path, self.FILE_KIND, self.settings())
+
+    @classmethod
+    def load(cls, path: str, mmap: bool = True):
+        structure = cls.__new__(cls)
+        tree, settings = cls.ARRAYS.load(path, cls.FILE_KIND, mmap)
+        structure.__attach(tree)
+        structure.load_settings(settings)
+        return structure
+
+    def __len__(self) -> int:
+        return len(self.tree)
+
+    @property
+    def points(self) -> List[Point]:
+        return self.tree.all_points()
+
+    def stats(self) -> TreeStats:
+        return self.tree.stats()
+
+    # places a point that was just added to the arrays at `index` in the tree
+    def insert_index(self, index: int, value: Optional[float]):
+        raise NotImplementedError
+
+    # restores the tree after remove_at took the point at `index` out of the leaf at the end of path
+    def after_remove(self, path: List[int], index: int):
+        raise NotImplementedError
+
+    # a tree built with values needs the value of every inserted point
+    def insert(self, point: Point, point_id: Optional[int] = None, value: Optional[float] = None) -> int:
+        self.__invalidate()
+        index = self.tree.add_point(point[0], point[1], point_id, value)
+        self.insert_index(index, value)
+        return index
+
+    def remove(self, point: Point) -> bool:
+        self.__invalidate()
+        found = self.tree.locate(point[0], point[1])
+        if found is None:
+            return False
+        path, position = found
+        self.after_remove(path, self.tree.remove_at(path, position))
+        return True
+
+    def __invalidate(self):
+        self.__visual_lines = None
+        if self.cache is not None:
+            self.cache.clear()
+
+    # lines drawn on top of the node boxes, such as the dividing lines of a kd-tree
+    def dividers(self) -> List[Line]:
+        return []
+
+    # lines of the node boxes and the dividers, drawn by every visualization until the tree changes
+    def __lines(self) -> Tuple[List[Line], List[Line]]:
+        if self.__visual_lines is None:
+            from visualization import tree_lines
+
+            self.__visual_lines = tree_lines(self.tree), self.dividers()
+        return self.__visual_lines
+
+    def range_search(self, rect: Rectangle, mode: SearchMode = SearchMode.LIST, tracer: Optional[Tracer] = None) \
+            -> Union[List[Point], Iterator[Point], array, int, bool]:
+        tree = self.tree
+        if mode in (SearchMode.ITER, SearchMode.COUNT, SearchMode.EXISTS):
+            if tracer is not None:
+                raise ValueError('{} searches cannot be traced'.format(mode))
+            if mode is SearchMode.ITER:
+                return map(tree.point, tree.iter_range(rect))
+            if mode is SearchMode.COUNT:
+                return tree.count_range(rect)
+            return tree.any_in_range(rect)
+
+        stats = self.query_stats.start() if self.query_stats is not None else None
+        if self.cache is not None and tracer is None:
+            result = self.cache.search(tree, rect, stats)
+        else:
+            result = tree.search_range(rect, combine(tracer, stats))
+        if stats is not None:
+            self.query_stats.finish(stats, len(result))
+        return tree.ids_of(result) if mode is SearchMode.INDICES else tree.points(result)
+
+    # the points found and a scene of every step of the search
+    def visualized_search(self, rect: Rectangle, mode: SearchMode = SearchMode.LIST,
+                          tracer: Optional[Tracer] = None) -> Tuple[List[Point], 'SearchScenes']:
+        if mode is not SearchMode.LIST:
+            raise ValueError('{} searches cannot be visualized'.format(mode))
+        from visualization import SearchScenes
+
+        recorder = TraceRecorder()
+        result = self.tree.search_range(rect, recorder if tracer is None else chain(recorder, tracer))
+        return self.tree.points(result), SearchScenes(self.tree, rect, result, recorder, *self.__lines())
+
+    def get_visualized(self) -> 'Scene':
+        from visualization import tree_scene
+
+        return tree_scene(self.tree, *self.__lines())
+
+    def estimate_count(self, rect: Rectangle, max_nodes: int = 64) -> float:
+        return self.tree.estimate_count(rect, max_nodes)
+
+    # COUNT, or the SUM, MIN or MAX of the values of a tree built with them, over the points in the rectangle
+    def aggregate(self, rect: Rectangle, op: Aggregate) -> Optional[float]:
+        return self.tree.aggregate_range(rect, op)
+
+    # ids (or indices) of the points in every rectangle, with the offsets of each rectangle's part
+    def range_search_many(self, rects: RectangleSource) -> Tuple[array, array]:
+        return self.tree.ids_of_many(*self.tree.search_many(rects))
@@ -0,0 +1,119 @@
+from array import array
+from enum import Enum, unique
+from math import log2
+from typing import Dict, List, NamedTuple, Optional, Sequence, Union
+from geometry import Point, Rectangle
+from flat_tree import PointSource, SearchMode, as_coordinates, as_ids
+from kd_tree import KDTree
+from quadtree import Quadtree
+
+
+@unique
+class Engine(Enum):
+    KD_TREE = 0
+    QUADTREE = 1
+    # a pass over every point, vectorized with numpy when it is installed
+    SCAN = 2
+
+
+# Seconds a query is expected to take: fixed + per_hit * points found + per_point * points held.
+class EngineCost(NamedTuple):
+    fixed: float
+    per_hit: float
+    per_point: float
+
+    def estimate(self, hits: float, points: int) -> float:
+        return self.fixed + self.per_hit * hits + self.per_point * points
+
+
+class QueryPlan(NamedTuple):
+    engine: Engine
+    estimated_count: float
+    costs: Dict[Engine, float]
+
+
+# Rough figures for CPython, meant to be replaced by benchmark.calibrate_planner on the target machine.
+# They only price the engines that can win without knowing the points: averaged over uniform and
+# clustered points the quadtree is a little cheaper than the kd-tree both per query and per point
+# found, and a scan without numpy does the per-hit work of a tree on top of a pass over every point.
+# Which tree suits a given set of points better is only known after calibrating on it.
+def default_costs(points: int, vectorized: bool) -> Dict[Engine, EngineCost]:
+    depth = log2(points + 2)
+    costs = {Engine.QUADTREE: EngineCost(5e-6 * depth, 4e-7, 0.0)}
+    if vectorized:
+        costs[Engine.SCAN] = EngineCost(2e-5, 1e-7, 3e-9)
+    return costs
+
+
+# Range searches over one set of points through whichever of a kd-tree, a quadtree and a linear
+# scan is expected to be the cheapest. Both trees are built over the same coordinate arrays and
+# the scan reads them too. The number of points a query finds is estimated from the quadtree's
+# node sizes and priced by the cost model `costs`, whose engines are the ones the planner picks
+# from; the plan of the latest search is `last_plan`. The kd-tree is only built once a search
+# uses it, which without calibration only a search naming its engine does.
+# The index is static, points cannot be inserted or removed. The trees stay private, as an update
+# through either of them would change the shared arrays under the other one and the scan.
+class SpatialIndex:
+    def __init__(self, points: PointSource, leaf_size: int = 1, ids: Optional[Sequence[int]] = None,
+                 estimate_nodes: int = 64):
+        self.xs, self.ys = as_coordinates(points)
+        self.ids: Optional[array] = as_ids(ids, len(self.xs)) if ids is not None else None
+        self.__leaf_size: int = leaf_size
+        self.__kd_tree: Optional[KDTree] = None
+        self.__quadtree: Quadtree = Quadtree.from_coordinates(self.xs, self.ys, leaf_size, ids=self.ids)
+        self.estimate_nodes: int = estimate_nodes
+        try:
+            import numpy
+        except ImportError:
+            numpy = None
+        self.__numpy = numpy
+        if numpy is not None:
+            self.__np_xs = numpy.frombuffer(self.xs, dtype=numpy.float64)
+            self.__np_ys = numpy.frombuffer(self.ys, dtype=numpy.float64)
+        self.costs: Dict[Engine, EngineCost] = default_costs(len(self.xs), numpy is not None)
+        self.last_plan: Optional[QueryPlan] = None
+
+    def __len__(self) -> int:
+        return len(self.xs)
+
+    @property
+    def vectorized(self) -> bool:
+        return self.__numpy is not None
+
+    def plan(self, rect: Rectangle) -> QueryPlan:
+        estimated_count = self.__quadtree.estimate_count(rect, self.estimate_nodes)
+        costs = {engine: cost.estimate(estimated_count, len(self)) for engine, cost in self.costs.items()}
+        return QueryPlan(min(costs, key=costs.get), estimated_count, costs)
+
+    # LIST returns the points found, INDICES their ids (or indices), COUNT their number, in no
+    # particular order; `engine` skips the planner.
+    def search(self, rect: Rectangle, mode: SearchMode = SearchMode.LIST, engine: Optional[Engine] = None) \
+            -> Union[List[Point], array, int]:
+        if mode not in (SearchMode.LIST, SearchMode.INDICES, SearchMode.COUNT):
+            raise ValueError('{} searches are not supported by the spatial index'.format(mode))
+        if engine is None:
+            self.last_plan = self.plan(rect)
+            engine = self.last_plan.engine
+        if engine is Engine.SCAN:
+            positions = self.__scan(rect)
+            if mode is SearchMode.COUNT:
+                return len(positions)
+            if mode is SearchMode.INDICES:
+                return positions if self.ids is None else array('q', [self.ids[i] for i in positions])
+            xs, ys = self.xs, self.ys
+            return [(xs[i], ys[i]) for i in positions]
+        if engine is Engine.KD_TREE:
+            if self.__kd_tree is None:
+                self.__kd_tree = KDTree.from_coordinates(self.xs, self.ys, self.__leaf_size, ids=self.ids)
+            return self.__kd_tree.search(rect.min_x, rect.max_x, rect.min_y, rect.max_y, mode=mode)
+        return self.__quadtree.find(rect, mode=mode)
+
+    def __scan(self, rect: Rectangle) -> array:
+        min_x, max_x, min_y, max_y = rect.min_x, rect.max_x, rect.min_y, rect.max_y
+        if self.__numpy is None:
+            return array('q', [
+                i for i, (x, y) in enumerate(zip(self.xs, self.ys)) if min_x < x <= max_x and min_y < y <= max_y
+            ])
+        xs, ys = self.__np_xs, self.__np_ys
+        mask = (xs > min_x) & (xs <= max_x) & (ys > min_y) & (ys <= max_y)
+        return array('q', self.__numpy.flatnonzero(mask).tolist())
@@ -1,14 +1,24 @@
-from typing import List, Callable
-from geometry import Point, Rectangle
+import os
+import subprocess
+import sys
+from typing import Dict, List, Callable
+from geometry import AxisType, Point, Rectangle
+from flat_tree import Aggregate, SearchMode, TreeStats
 from gen_data import *
 from timeit import default_timer
-from kd_tree import KDTree
+from kd_tree import KDTree, SplitPolicy
 from quadtree import Quadtree
+from morton_quadtree import MortonQuadtree
 
+# seconds a fresh interpreter may spend importing the search structures
+IMPORT_TIME_BUDGET = 0.25
+_PLOTTING_MODULES = ('draw_tool', 'matplotlib', 'numpy')
 
-def test_kd_buildup(points: List[Point]) -> float:
+
+def test_kd_buildup(points: List[Point], split_policy: SplitPolicy = SplitPolicy.SAMPLED_MEDIAN,
+                    presorted: bool = False) -> float:
     start_time = default_timer()
-    _ = KDTree(points)
+    _ = KDTree(points, split_policy=split_policy, presorted=presorted)
     end_time = default_timer()
     return end_time - start_time
 
@@ -20,6 +30,33 @@ def test_quadtree_buildup(points: List[Point]) -> float:
     return end_time - start_time
 
 
+def test_morton_buildup(points: List[Point]) -> float:
+    start_time = default_timer()
+    _ = MortonQuadtree(points)
+    end_time = default_timer()
+    return end_time - start_time
+
+
+def test_import_time(modules: Tuple[str, ...] = ('kd_tree', 'quadtree')) -> float:
+    code = (
+        'import sys\n'
+        'from timeit import default_timer\n'
+        'start_time = default_timer()\n'
+        'import {}\n'
+        'print(default_timer() - start_time)\n'
+        'print(",".join(name for name in {} if name in sys.modules))\n'
+    ).format(', '.join(modules), _PLOTTING_MODULES)
+    output = subprocess.run(
+        [sys.executable, '-c', code], cwd=os.path.dirname(os.path.abspath(__file__)),
+        check=True, stdout=subprocess.PIPE, universal_newlines=True
+    ).stdout.split('\n')
+    import_time, loaded = float(output[0]), output[1]
+    assert loaded == '', 'importing {} loaded {}'.format(', '.join(modules), loaded)
+    assert import_time < IMPORT_TIME_BUDGET, \
+        'importing {} took {:.3f}s, budget is {}s'.format(', '.join(modules), import_time, IMPORT_TIME_BUDGET)
+    return import_time
+
+
 def test_kd_search(points: List[Point], rectangles: List[Rectangle]) -> List[float]:
     tree = KDTree(points)
 
@@ -45,6 +82,72 @@ def test_quadtree_search(points: List[Point], rectangles: List[Rectangle]) -> Li
     return list(map(time_individual, rectangles))
 
 
+def test_morton_search(points: List[Point], rectangles: List[Rectangle]) -> List[float]:
+    tree = MortonQuadtree(points)
+
+    def time_individual(rectangle: Rectangle) -> float:
+        start_time = default_timer()
+        tree.find(rectangle)
+        end_time = default_timer()
+        return end_time - start_time
+
+    return list(map(time_individual, rectangles))
+
+
+# build time, mean search time and shape of a kd-tree built with every split policy
+def test_kd_split_policies(points: List[Point], rectangles: List[Rectangle]) \
+        -> List[Tuple[SplitPolicy, float, float, TreeStats]]:
+    results = []
+    for policy in SplitPolicy:
+        start_time = default_timer()
+        tree = KDTree(points, split_policy=policy)
+        build_time = default_timer() - start_time
+        start_time = default_timer()
+        for rectangle in rectangles:
+            tree.search(*rectangle.to_tuple())
+        search_time = (default_timer() - start_time) / len(rectangles)
+        results.append((policy, build_time, search_time, tree.stats()))
+    return results
+
+
+# mean seconds of summing point values over the rectangles from node summaries, and by listing
+# the points found and summing their values
+def test_kd_aggregate(points: List[Point], rectangles: List[Rectangle]) -> Tuple[float, float]:
+    values = [float(i % 100) for i in range(len(points))]
+    tree = KDTree(points, values=values)
+    start_time = default_timer()
+    for rectangle in rectangles:
+        tree.search_aggregate(rectangle, Aggregate.SUM)
+    aggregate_time = (default_timer() - start_time) / len(rectangles)
+    start_time = default_timer()
+    for rectangle in rectangles:
+        sum(values[i] for i in tree.search(*rectangle.to_tuple(), mode=SearchMode.INDICES))
+    listing_time = (default_timer() - start_time) / len(rectangles)
+    return aggregate_time, listing_time
+
+
+# mean seconds per call of the Rectangle operations the trees and the query cache rely on,
+# over every ordered pair of the given rectangles
+def test_rectangle_ops(rectangles: List[Rectangle]) -> Dict[str, float]:
+    pairs = [(a, b) for a in rectangles for b in rectangles]
+    operations: Dict[str, Callable[[Rectangle, Rectangle], object]] = {
+        'contains': lambda a, b: a.contains(b),
+        'intersects': lambda a, b: a.intersects(b),
+        'le': lambda a, b: a <= b,
+        'and': lambda a, b: a & b,
+        'less_than': lambda a, b: a.less_than(b.min_x, AxisType.Y),
+        'greater_than': lambda a, b: a.greater_than(b.min_y, AxisType.X)
+    }
+    results: Dict[str, float] = {}
+    for name, operation in operations.items():
+        start_time = default_timer()
+        for a, b in pairs:
+            operation(a, b)
+        end_time = default_timer()
+        results[name] = (end_time - start_time) / len(pairs)
+    return results
+
+
 class Tester:
     def __init__(self, n_values: List[int], rectangle_amount_per_test: int, scope: Tuple[float, float] = (0, 100)):
         self.n_values: List[int] = n_values
@@ -77,6 +180,49 @@ class Tester:
         self.print_tests_csv(test_quadtree_buildup, test_quadtree_search, base_filename + '_quadtree')
         self.print_tests_csv(test_kd_buildup, test_kd_search, base_filename + '_kd_tree')
 
+    def print_morton_tests_csv(self, base_filename: str):
+        self.print_tests_csv(test_morton_buildup, test_morton_search, base_filename + '_morton_quadtree')
+
+    # the sampled median builder against the exact median one, with and without presorting
+    def print_kd_builder_tests_csv(self, filename: str):
+        builders: List[Tuple[str, Callable[[List[Point]], float]]] = [
+            ('sampled', test_kd_buildup),
+            ('exact', lambda points: test_kd_buildup(points, SplitPolicy.EXACT_MEDIAN)),
+            ('presorted', lambda points: test_kd_buildup(points, SplitPolicy.EXACT_MEDIAN, presorted=True))
+        ]
+        with open(filename + '_kd_builders.csv', 'w') as file:
+            file.write('n;builder;time\n')
+            for i in range(len(self.n_values)):
+                for name, buildup_tester in builders:
+                    buildup_time = buildup_tester(self.test_points[i])
+                    file.write(str(self.n_values[i]) + ';' + name + ';' + str(buildup_time) + '\n')
+
+    def print_split_policy_tests_csv(self, filename: str):
+        with open(filename + '_split_policies.csv', 'w') as file:
+            file.write('n;policy;build_time;mean_search_time;max_depth;mean_point_depth;max_child_share\n')
+            for i in range(len(self.n_values)):
+                for policy, build_time, search_time, stats in test_kd_split_policies(
+                        self.test_points[i], self.test_rectangles[i]
+                ):
+                    file.write(';'.join(map(str, (
+                        self.n_values[i], policy.name, build_time, search_time,
+                        stats.max_depth, stats.mean_point_depth, stats.max_child_share
+                    ))) + '\n')
+
+    def print_aggregate_tests_csv(self, filename: str):
+        with open(filename + '_kd_aggregate.csv', 'w') as file:
+            file.write('n;aggregate_time;listing_time\n')
+            for i in range(len(self.n_values)):
+                aggregate_time, listing_time = test_kd_aggregate(self.test_points[i], self.test_rectangles[i])
+                file.write(str(self.n_values[i]) + ';' + str(aggregate_time) + ';' + str(listing_time) + '\n')
+
+    def print_rectangle_tests_csv(self, filename: str):
+        with open(filename + '_rectangle_ops.csv', 'w') as file:
+            file.write('n;operation;mean_time\n')
+            for i in range(len(self.n_values)):
+                for name, mean_time in test_rectangle_ops(self.test_rectangles[i]).items():
+                    file.write(str(self.n_values[i]) + ';' + name + ';' + str(mean_time) + '\n')
+
 
 class TesterCluster(Tester):
     def __init__(self,
@@ -98,3 +244,17 @@ class TesterCluster(Tester):
                 self.n_values
             )
         )
+
+
+class TesterDuplicates(Tester):
+    def __init__(self,
+                 n_values: List[int],
+                 rectangle_amount_per_test: int,
+                 scope: Tuple[float, float] = (0, 100),
+                 spot_amount: int = 5,
+                 jitter: float = 0
+                 ):
+        super().__init__(n_values, rectangle_amount_per_test, scope)
+        self.test_points = list(
+            map(lambda n: gen_point_duplicates(scope=scope, n=n, spot_amount=spot_amount, jitter=jitter), self.n_values)
+        )
@@ -0,0 +1,118 @@
+from array import array
+from enum import IntEnum
+from typing import Callable, Dict, Optional, Tuple
+
+TraceRecord = Tuple['TraceEvent', int, int, int]
+
+
+class TraceEvent(IntEnum):
+    # the node's box was tested and lies outside of the query
+    PRUNE = 0
+    # the node overlaps the query only partially, its children will be tested
+    VISIT = 1
+    # the node lies inside of the query, all of its points were taken without testing them
+    TAKE = 2
+    # the node is a leaf overlapping the query, its points were tested one by one
+    SCAN = 3
+
+
+# A tracer is called with the event, the node and the range [first_hit, end_hit) of result
+# positions the event added. Searches run without one take a separate path that never checks.
+Tracer = Callable[[TraceEvent, int, int, int], None]
+
+
+def chain(*tracers: Tracer) -> Tracer:
+    def call_all(event: TraceEvent, node: int, first_hit: int, end_hit: int):
+        for tracer in tracers:
+            tracer(event, node, first_hit, end_hit)
+
+    return call_all
+
+
+# the tracers that are set chained into one, None when neither is
+def combine(first: Optional[Tracer], second: Optional[Tracer]) -> Optional[Tracer]:
+    if first is None:
+        return second
+    if second is None:
+        return first
+    return chain(first, second)
+
+
+class TraceRecorder:
+    def __init__(self):
+        self.events: array = array('b')
+        self.nodes: array = array('q')
+        self.first_hits: array = array('q')
+        self.end_hits: array = array('q')
+
+    def __call__(self, event: TraceEvent, node: int, first_hit: int, end_hit: int):
+        self.events.append(event)
+        self.nodes.append(node)
+        self.first_hits.append(first_hit)
+        self.end_hits.append(end_hit)
+
+    def __len__(self) -> int:
+        return len(self.events)
+
+    def __getitem__(self, i: int) -> TraceRecord:
+        return TraceEvent(self.events[i]), self.nodes[i], self.first_hits[i], self.end_hits[i]
+
+
+# Work done by one range search, or summed over several: a tracer counting the nodes the search
+# tested by outcome, plus the number of points it returned, filled in by the tree afterwards.
+class QueryStats:
+    def __init__(self):
+        self.queries: int = 0
+        self.nodes_visited: int = 0
+        self.nodes_pruned: int = 0
+        self.subtrees_taken: int = 0
+        self.leaves_scanned: int = 0
+        self.points_returned: int = 0
+
+    def __call__(self, event: TraceEvent, node: int, first_hit: int, end_hit: int):
+        self.nodes_visited += 1
+        if event == TraceEvent.PRUNE:
+            self.nodes_pruned += 1
+        elif event == TraceEvent.TAKE:
+            self.subtrees_taken += 1
+        elif event == TraceEvent.SCAN:
+            self.leaves_scanned += 1
+
+    def add(self, other: 'QueryStats'):
+        self.queries += other.queries
+        self.nodes_visited += other.nodes_visited
+        self.nodes_pruned += other.nodes_pruned
+        self.subtrees_taken += other.subtrees_taken
+        self.leaves_scanned += other.leaves_scanned
+        self.points_returned += other.points_returned
+
+    def as_dict(self) -> Dict[str, int]:
+        return dict(vars(self))
+
+
+# Set as a tree's query_stats to count the work of its range searches. Every sample_every-th
+# search is traced, the others take the untraced path; a search answered from the tree's query
+# cache visits no nodes. `last` holds the latest sampled search, `total` the sum of all of them.
+class StatsCollector:
+    def __init__(self, sample_every: int = 1):
+        if sample_every < 1:
+            raise ValueError('sample_every has to be positive, got {}'.format(sample_every))
+        self.sample_every: int = sample_every
+        self.searches: int = 0
+        self.last: Optional[QueryStats] = None
+        self.total: QueryStats = QueryStats()
+
+    def start(self) -> Optional[QueryStats]:
+        self.searches += 1
+        return QueryStats() if (self.searches - 1) % self.sample_every == 0 else None
+
+    def finish(self, stats: QueryStats, points_returned: int):
+        stats.queries = 1
+        stats.points_returned = points_returned
+        self.last = stats
+        self.total.add(stats)
+
+    def reset(self):
+        self.searches = 0
+        self.last = None
+        self.total = QueryStats()
@@ -0,0 +1,91 @@
+from array import array
+from collections.abc import Sequence
+from typing import List, Union
+
+from draw_tool import Scene, PointsCollection, LinesCollection
+from flat_tree import FlatTree
+from geometry import Line, Rectangle
+from tracing import TraceEvent, TraceRecorder
+
+_COLOR_SEARCHED_RECT = "black"
+_COLOR_CONSIDERED_NOW = "red"
+_COLOR_FOUND_POINT = "red"
+_COLOR_VISITED = "green"
+_COLOR_DIVIDER = "yellow"
+
+
+def tree_lines(tree: FlatTree) -> List[Line]:
+    lines: List[Line] = []
+    stack = [0]
+    while len(stack) > 0:
+        node = stack.pop()
+        if tree.size[node] > 0:
+            lines.extend(tree.node_lines(node))
+        stack.extend(tree.children(node))
+    return lines
+
+
+# `lines` are the tree_lines of the tree, which its owner computes once and keeps until the tree changes
+def tree_scene(tree: FlatTree, lines: List[Line], dividers: List[Line] = ()) -> Scene:
+    return Scene(
+        points=[PointsCollection(tree.all_points())],
+        lines=[LinesCollection(list(lines)), LinesCollection(list(dividers), color=_COLOR_DIVIDER)]
+    )
+
+
+# Scenes of a traced search, one per recorded node visit, built only when a plot asks for them.
+# Pruned nodes are not shown, everything else is looked up from the event arrays.
+class SearchScenes(Sequence):
+    def __init__(self, tree: FlatTree, rect: Rectangle, result: array, recorder: TraceRecorder, lines: List[Line],
+                 dividers: List[Line] = ()):
+        self.__tree: FlatTree = tree
+        self.__result: array = result
+        self.__recorder: TraceRecorder = recorder
+        self.__shown: array = array('q', [
+            i for i in range(len(recorder)) if recorder.events[i] != TraceEvent.PRUNE
+        ])
+        self.__points = PointsCollection(tree.all_points())
+        self.__lines = LinesCollection(list(lines))
+        self.__dividers = LinesCollection(list(dividers), color=_COLOR_DIVIDER)
+        self.__rect = LinesCollection(rect.get_lines(), color=_COLOR_SEARCHED_RECT)
+        self.__extra: List[Scene] = []
+
+    def __len__(self) -> int:
+        return 1 + len(self.__shown) + len(self.__extra)
+
+    def __getitem__(self, i: Union[int, slice]) -> Union[Scene, List[Scene]]:
+        if isinstance(i, slice):
+            return [self[j] for j in range(*i.indices(len(self)))]
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError('scene index out of range')
+        if i == 0:
+            return Scene(points=[self.__points], lines=[self.__lines, self.__dividers, self.__rect])
+        if i > len(self.__shown):
+            return self.__extra[i - len(self.__shown) - 1]
+
+        tree, recorder = self.__tree, self.__recorder
+        current = self.__shown[i - 1]
+        visited: List[Line] = []
+        for j in self.__shown[:i - 1]:
+            visited.extend(tree.node_lines(recorder.nodes[j]))
+        return Scene(
+            points=[
+                self.__points,
+                PointsCollection(tree.points(self.__result[:recorder.end_hits[current]]), color=_COLOR_FOUND_POINT)
+            ],
+            lines=[
+                self.__lines,
+                self.__dividers,
+                self.__rect,
+                LinesCollection(visited, color=_COLOR_VISITED),
+                LinesCollection(tree.node_lines(recorder.nodes[current]), color=_COLOR_CONSIDERED_NOW)
+            ]
+        )
+
+    def append(self, scene: Scene):
+        self.__extra.append(scene)
+
+    def __add__(self, other: List[Scene]) -> List[Scene]:
+        return list(self) + list(other)